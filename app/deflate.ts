@@ -0,0 +1,20 @@
+/**
+ * Inflating of the frames of the chrono.msgpack.deflate subprotocol, which start with a byte
+ * telling if the msgpack payload after it is compressed as raw deflate.
+ */
+
+export const DEFLATED = 1;
+
+export function supportsDeflate(): boolean {
+	try {
+		new DecompressionStream("deflate-raw");
+		return true;
+	} catch {
+		return false;
+	}
+}
+
+export async function inflate(data: Uint8Array): Promise<ArrayBuffer> {
+	const stream = new Blob([data]).stream().pipeThrough(new DecompressionStream("deflate-raw"));
+	return await new Response(stream).arrayBuffer();
+}
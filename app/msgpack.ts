@@ -0,0 +1,81 @@
+/**
+ * Minimal msgpack decoder, covering the types the backend sends: maps, arrays, strings,
+ * integers, floats, booleans and nil.
+ */
+const textDecoder = new TextDecoder();
+
+class Reader {
+	private offset = 0;
+	private readonly view: DataView;
+
+	constructor(private readonly bytes: Uint8Array) {
+		this.view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+	}
+
+	public read(): any {
+		const type = this.view.getUint8(this.offset++);
+
+		if (type <= 0x7f) return type;  // positive fixint
+		if (type >= 0xe0) return type - 0x100;  // negative fixint
+		if ((type & 0xf0) === 0x80) return this.map(type & 0x0f);
+		if ((type & 0xf0) === 0x90) return this.array(type & 0x0f);
+		if ((type & 0xe0) === 0xa0) return this.str(type & 0x1f);
+
+		switch (type) {
+			case 0xc0: return null;
+			case 0xc2: return false;
+			case 0xc3: return true;
+			case 0xca: return this.advance(4, this.view.getFloat32(this.offset));
+			case 0xcb: return this.advance(8, this.view.getFloat64(this.offset));
+			case 0xcc: return this.advance(1, this.view.getUint8(this.offset));
+			case 0xcd: return this.advance(2, this.view.getUint16(this.offset));
+			case 0xce: return this.advance(4, this.view.getUint32(this.offset));
+			case 0xcf: return this.advance(8, Number(this.view.getBigUint64(this.offset)));
+			case 0xd0: return this.advance(1, this.view.getInt8(this.offset));
+			case 0xd1: return this.advance(2, this.view.getInt16(this.offset));
+			case 0xd2: return this.advance(4, this.view.getInt32(this.offset));
+			case 0xd3: return this.advance(8, Number(this.view.getBigInt64(this.offset)));
+			case 0xd9: return this.str(this.advance(1, this.view.getUint8(this.offset)));
+			case 0xda: return this.str(this.advance(2, this.view.getUint16(this.offset)));
+			case 0xdb: return this.str(this.advance(4, this.view.getUint32(this.offset)));
+			case 0xdc: return this.array(this.advance(2, this.view.getUint16(this.offset)));
+			case 0xdd: return this.array(this.advance(4, this.view.getUint32(this.offset)));
+			case 0xde: return this.map(this.advance(2, this.view.getUint16(this.offset)));
+			case 0xdf: return this.map(this.advance(4, this.view.getUint32(this.offset)));
+		}
+
+		throw new Error("Unsupported msgpack type 0x" + type.toString(16));
+	}
+
+	private advance<T>(size: number, value: T): T {
+		this.offset += size;
+		return value;
+	}
+
+	private str(length: number): string {
+		const value = textDecoder.decode(this.bytes.subarray(this.offset, this.offset + length));
+		this.offset += length;
+		return value;
+	}
+
+	private array(length: number): any[] {
+		const value = new Array(length);
+		for (let i = 0; i < length; i++) {
+			value[i] = this.read();
+		}
+		return value;
+	}
+
+	private map(length: number): Record<string, any> {
+		const value: Record<string, any> = {};
+		for (let i = 0; i < length; i++) {
+			const key = this.read();
+			value[key] = this.read();
+		}
+		return value;
+	}
+}
+
+export function decode(data: ArrayBuffer | Uint8Array): any {
+	return new Reader(data instanceof Uint8Array ? data : new Uint8Array(data)).read();
+}
@@ -1,4 +1,21 @@
 const MAX_RETRIES = 10;
+// Sent by the server when it sheds connections, with the delay to wait in the reason
+const TRY_AGAIN_LATER = 1013;
+const RETRY_AFTER_PREFIX = "retry-after=";
+
+// Randomize a delay between half and one and a half times its value, so clients disconnected
+// together don't all reconnect at the same moment
+function jitter(delay: number): number {
+    return delay * (0.5 + Math.random());
+}
+
+function retryAfter(event: CloseEvent): number | null {
+    if (event.code !== TRY_AGAIN_LATER || !event.reason.startsWith(RETRY_AFTER_PREFIX)) {
+        return null;
+    }
+    const seconds = parseFloat(event.reason.slice(RETRY_AFTER_PREFIX.length));
+    return isNaN(seconds) ? null : seconds * 1000;
+}
 
 export interface Callbacks {
     onConnected(socket: ChronoSocket): void;
@@ -16,8 +33,9 @@ export class ChronoSocket {
     private attempts: number = MAX_RETRIES;
 
     constructor(
-        public readonly url: string,
+        private readonly url: () => string,
         private readonly callbacks: Callbacks,
+        private readonly protocols: string[] = [],
     ) {
     }
 
@@ -26,7 +44,8 @@ export class ChronoSocket {
     }
 
     public connect(): void {
-        this.socket = new WebSocket(this.url);
+        this.socket = new WebSocket(this.url(), this.protocols);
+        this.socket.binaryType = "arraybuffer";
         this.socket.onopen = () => {
             this.attempts = MAX_RETRIES;
             this.callbacks.onConnected(this);
@@ -40,11 +59,18 @@ export class ChronoSocket {
                 return;
             }
 
-            if (this.attempts-- > 0) {
+            const retryWindow = retryAfter(event);
+            if (retryWindow !== null) {
+                // The server is up but busy, it doesn't count as a failed attempt
                 this.callbacks.onDisconnected(this);
                 setTimeout(() => {
                     this.connect();
-                }, 1.1 ** (MAX_RETRIES - this.attempts) * 1000); // Exponential backoff
+                }, Math.random() * retryWindow); // Spread over the window given by the server
+            } else if (this.attempts-- > 0) {
+                this.callbacks.onDisconnected(this);
+                setTimeout(() => {
+                    this.connect();
+                }, jitter(1.1 ** (MAX_RETRIES - this.attempts) * 1000)); // Exponential backoff
             } else {
                 this.callbacks.onLost(this);
             }
@@ -52,6 +78,12 @@ export class ChronoSocket {
         this.socket.onmessage = this.callbacks.onMessage;
     }
 
+    public send(data: string | ArrayBuffer): void {
+        if (this.socket !== null && this.socket.readyState === WebSocket.OPEN) {
+            this.socket.send(data);
+        }
+    }
+
     public close(): void {
         if (this.socket !== null) {
             this.socket.close(1000);
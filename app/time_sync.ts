@@ -1,88 +1,84 @@
 type TimeSample = {
-	t1: number;
-	t2: number;
-	t3: number;
-	t4: number;
+	offset: number;
+	rtt: number;
 };
 
+/** High-resolution wall clock, in milliseconds since the epoch */
+function now(): number {
+	return performance.timeOrigin + performance.now();
+}
+
+/**
+ * NTP-like clock synchronization, over any websocket answering binary time sync requests:
+ * a little-endian float64 t1, answered with the three float64 t1, t2 and t3.
+ */
 export class TimeSync {
-	private ws: WebSocket;
-	private samples: number[] = [];
-	private rttSamples: number[] = [];
+	private samples: TimeSample[] = [];
 	private pendingResolve?: (offset: number) => void;
 	private readonly targetSamples: number;
-	private isReady = false;
+	private offset = 0;
 
-	constructor(private url: string, sampleCount = 10) {
+	constructor(private readonly send: (data: ArrayBuffer) => void, sampleCount = 8) {
 		this.targetSamples = sampleCount;
-		this.ws = new WebSocket(url);
-
-		this.ws.onmessage = (event) => this.handleMessage(event);
 	}
 
-	/** Perform an async synchronization — resolves when enough samples are ready */
+	/** Start a new synchronization — resolves when enough samples are ready */
 	public async synchronize(): Promise<number> {
-		if (this.isReady) {
-			// already synced
-			return this.getAverageOffset();
-		}
+		this.samples = [];
 
 		return new Promise<number>((resolve) => {
 			this.pendingResolve = resolve;
-			this.startSampling();
+
+			// All the pings are sent at once, without waiting for the replies
+			for (let i = 0; i < this.targetSamples; i++) {
+				this.send(new Float64Array([now()]).buffer);
+			}
 		});
 	}
 
-	/** Internal: send a batch of sync pings */
-	private startSampling() {
-		// Wait until websocket is open
-		if (this.ws.readyState !== WebSocket.OPEN) {
-			this.ws.onopen = () => this.startSampling();
-			return;
-		}
-
-		for (let i = 0; i < this.targetSamples; i++) {
-			setTimeout(() => {
-				const t1 = Date.now();
-				this.ws.send(JSON.stringify({ t1 }));
-			}, i * 200); // 200ms apart
-		}
+	/** Handle a binary time sync reply from the server */
+	public handleReply(data: ArrayBuffer) {
+		const view = new DataView(data);
+		this.addSample(view.getFloat64(0, true), view.getFloat64(8, true), view.getFloat64(16, true));
 	}
 
-	/** Internal: handle each response from the server */
-	private handleMessage(event: MessageEvent) {
-		const t4 = Date.now();
-		const { t1, t2, t3 } = JSON.parse(event.data) as TimeSample;
-
-		const offset = ((t2 - t1) + (t3 - t4)) / 2;
-		const rtt = (t4 - t1) - (t3 - t2);
-
-		// Filter out high-delay samples to improve accuracy
-		if (rtt < 500) {
-			this.samples.push(offset);
+	/** Handle the timestamps of a time sync reply, when they were already decoded */
+	public addSample(t1: number, t2: number, t3: number) {
+		const t4 = now();
+		if (!this.pendingResolve) {
+			return;  // Late reply of a synchronization that is already complete
 		}
-		this.rttSamples.push(rtt);
 
-		if (this.samples.length >= this.targetSamples && !this.isReady) {
-			this.isReady = true;
-			const avgOffset = this.getAverageOffset();
-			this.pendingResolve?.(avgOffset);
-			this.ws.close(1000, "Time sync complete");
+		this.samples.push({
+			offset: ((t2 - t1) + (t3 - t4)) / 2,
+			rtt: (t4 - t1) - (t3 - t2),
+		});
+
+		if (this.samples.length >= this.targetSamples) {
+			this.offset = this.getBestOffset();
+			this.pendingResolve(this.offset);
+			this.pendingResolve = undefined;
 		}
 	}
 
-	/** Get average offset (positive means server is ahead) */
-	private getAverageOffset(): number {
-		return this.samples.reduce((a, b) => a + b, 0) / this.samples.length;
+	/**
+	 * Average the offsets of the half of the samples with the lowest round trip time,
+	 * the ones least skewed by queueing (positive means server is ahead)
+	 */
+	private getBestOffset(): number {
+		const best = [...this.samples]
+			.sort((a, b) => a.rtt - b.rtt)
+			.slice(0, Math.max(1, Math.floor(this.samples.length / 2)));
+
+		return best.reduce((a, b) => a + b.offset, 0) / best.length;
 	}
 
 	public getAverageRTT(): number {
-		return this.rttSamples.reduce((a, b) => a + b, 0) / this.rttSamples.length;
+		return this.samples.reduce((a, b) => a + b.rtt, 0) / this.samples.length;
 	}
 
 	/** Return server time based on current offset */
 	public getServerTime(): Date {
-		const avgOffset = this.getAverageOffset();
-		return new Date(Date.now() + avgOffset);
+		return new Date(Date.now() + this.offset);
 	}
 }
@@ -0,0 +1,108 @@
+import base64
+import binascii
+import json
+from typing import Any, Literal
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.asynchronous.collection import AsyncCollection
+
+SortField = Literal["last_modified", "origin", "timer_count"]
+SortOrder = Literal["asc", "desc"]
+
+
+async def backfill_index_fields(db_collection: AsyncCollection) -> None:
+    """
+    Add the fields sorted on by the admin index to the pages written before they existed.
+
+    Documents missing them would sort as null, and a cursor cannot resume past null values.
+    """
+    await db_collection.update_many(
+        {"timer_count": None},
+        [{"$set": {"timer_count": {"$size": {"$ifNull": ["$timers", []]}}}}],
+    )
+    await db_collection.update_many({"origin": None}, {"$set": {"origin": "unknown://"}})
+
+
+async def create_admin_indexes(db_collection: AsyncCollection) -> None:
+    """Create the indexes used to filter and sort the admin index."""
+    await db_collection.create_index([("origin", ASCENDING), ("last_modified", ASCENDING)])
+    await db_collection.create_index([("last_modified", ASCENDING), ("_id", ASCENDING)])
+    await db_collection.create_index([("origin", ASCENDING), ("_id", ASCENDING)])
+    await db_collection.create_index([("timer_count", ASCENDING), ("_id", ASCENDING)])
+
+
+def encode_cursor(value: Any, public_link: str) -> str:  # noqa: ANN401 - any sortable value
+    """Encode the position after a page in the index, so the next request can resume from it."""
+    return base64.urlsafe_b64encode(json.dumps([value, public_link]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[Any, str]:
+    """Decode a cursor made by encode_cursor, raising ValueError if it is invalid."""
+    try:
+        value, public_link = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    return value, public_link
+
+
+async def query_index(
+    db_collection: AsyncCollection,
+    *,
+    origins: list[str],
+    sort: SortField,
+    order: SortOrder,
+    limit: int,
+    cursor: str | None,
+) -> dict:
+    """Return a page of the admin index, with the cursor to get the next one if any."""
+    conditions: list[dict] = []
+    if origins:
+        conditions.append({"origin": {"$in": origins}})
+
+    if cursor:
+        value, public_link = decode_cursor(cursor)
+        operator = "$gt" if order == "asc" else "$lt"
+        conditions.append(
+            {"$or": [{sort: {operator: value}}, {sort: value, "_id": {operator: public_link}}]}
+        )
+
+    direction = ASCENDING if order == "asc" else DESCENDING
+    documents = db_collection.find(
+        {"$and": conditions} if conditions else {},
+        {"_id": False},
+        sort=[(sort, direction), ("_id", direction)],
+        limit=limit + 1,  # One more, to know if there is a next page
+    )
+
+    pages = [document async for document in documents]
+
+    next_cursor = None
+    if len(pages) > limit:
+        pages.pop()
+        last = pages[-1]
+        next_cursor = encode_cursor(last.get(sort), last["public_link"])
+
+    return {"pages": pages, "next_cursor": next_cursor}
+
+
+async def index_stats(db_collection: AsyncCollection) -> dict:
+    """Count pages and timers per origin, without loading the pages."""
+    per_origin = {}
+    total_pages = total_timers = 0
+
+    async for group in await db_collection.aggregate(
+        [
+            {
+                "$group": {
+                    "_id": "$origin",
+                    "pages": {"$sum": 1},
+                    "timers": {"$sum": {"$size": {"$ifNull": ["$timers", []]}}},
+                }
+            }
+        ]
+    ):
+        per_origin[group["_id"]] = {"pages": group["pages"], "timers": group["timers"]}
+        total_pages += group["pages"]
+        total_timers += group["timers"]
+
+    return {"total_pages": total_pages, "total_timers": total_timers, "per_origin": per_origin}
@@ -0,0 +1,89 @@
+import time
+
+from starlette.websockets import WebSocket
+
+from backend.messages import negotiate
+from backend.metrics import registry
+
+# "Try Again Later", clients reconnect after the delay given in the reason of the close frame
+RETRY_CLOSE_CODE = 1013
+RETRY_AFTER_PREFIX = "retry-after="
+MIN_RETRY_AFTER = 1.0  # seconds
+MAX_RETRY_AFTER = 60.0  # seconds
+
+# Share of the rate available right after startup, growing linearly until the end of the warm-up
+WARMUP_INITIAL_FRACTION = 0.1
+
+ADMISSIONS = registry.counter(
+    "chrono_websocket_admissions_total",
+    "Websocket connections accepted or shed by admission control",
+    ("endpoint", "result"),
+)
+
+
+class AdmissionControl:
+    """
+    A token bucket limiting how fast websockets are accepted, slower while warming up.
+
+    After a restart every client reconnects at once while the caches of the worker are still
+    empty, so the rate starts at a fraction of its nominal value and ramps up during the warm-up.
+    Shed clients are told to come back within a window long enough for everyone being shed to
+    be accepted at the current rate, and pick a random moment in it.
+    """
+
+    def __init__(self, endpoint: str, rate: float, warmup: float) -> None:
+        self.endpoint = endpoint
+        self.rate = rate  # Connections per second, 0 or less to accept everything
+        self.warmup = warmup
+        self.started = self.last_refill = time.monotonic()
+
+        self.tokens = self.current_rate(self.started)  # Start with a full bucket
+        self.backlog = 0.0  # Shed clients expected to come back, drained at the current rate
+
+        self.accepted = ADMISSIONS.labels(endpoint, "accepted")
+        self.shed = ADMISSIONS.labels(endpoint, "shed")
+
+    def start(self) -> None:
+        """Start the warm-up, once the app is ready to handle connections."""
+        self.started = self.last_refill = time.monotonic()
+        self.tokens = self.current_rate(self.started)
+        self.backlog = 0.0
+
+    def current_rate(self, now: float) -> float:
+        """Return how many connections per second are accepted at the moment."""
+        if self.warmup <= 0:
+            return self.rate
+        progress = min(1.0, (now - self.started) / self.warmup)
+        return self.rate * (WARMUP_INITIAL_FRACTION + (1 - WARMUP_INITIAL_FRACTION) * progress)
+
+    def admit(self) -> float | None:
+        """Count a new connection, and return how long it must wait if it is shed."""
+        if self.rate <= 0:
+            self.accepted.inc()
+            return None
+
+        now = time.monotonic()
+        rate = self.current_rate(now)
+        elapsed = now - self.last_refill
+        self.last_refill = now
+
+        # At most a second worth of connections can be accepted in a burst
+        self.tokens = min(rate, self.tokens + elapsed * rate)
+        self.backlog = max(0.0, self.backlog - elapsed * rate)
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.accepted.inc()
+            return None
+
+        self.backlog += 1
+        self.shed.inc()
+        return min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, self.backlog / rate))
+
+
+async def shed(websocket: WebSocket, retry_after: float) -> None:
+    """Close a websocket that wasn't admitted, telling the client when to try again."""
+    # Browsers only expose the close code and reason of accepted websockets, and fail the
+    # handshake if they offered subprotocols and none was picked
+    await websocket.accept(negotiate(websocket.scope.get("subprotocols", [])))
+    await websocket.close(code=RETRY_CLOSE_CODE, reason=f"{RETRY_AFTER_PREFIX}{retry_after:.1f}")
@@ -1,7 +1,12 @@
+import asyncio
 import datetime
+import logging
+import time
 
 import aiohttp
 from pydantic.main import BaseModel
+from pymongo import UpdateOne
+from pymongo.asynchronous.collection import AsyncCollection
 
 from backend.constants import (
     CLOUDFLARE_ACCOUNT_ID,
@@ -11,54 +16,22 @@ from backend.constants import (
 
 DATA_QUERY = """
 query rumData(
-    $accountTag: string!, $now: Time, $shortSampling: Time, $longSampling: Time, $hosts: [string!]
+    $accountTag: string!, $since: Time, $until: Time, $host: string!, $after: string!,
+    $limit: uint64!
   ) {
   viewer {
     accounts(filter: {accountTag: $accountTag}) {
-      shortPathData: rumPageloadEventsAdaptiveGroups(
-        filter: {datetime_lt: $now, datetime_geq: $shortSampling, requestHost_in: $hosts, bot: 0}
-        limit: 10000
-      ) {
-        count
-        dimensions {
-          requestHost
-          requestPath
-        }
-      }
-
-      longPathData: rumPageloadEventsAdaptiveGroups(
+      pathData: rumPageloadEventsAdaptiveGroups(
         filter: {
-          datetime_lt: $shortSampling, datetime_geq: $longSampling, requestHost_in: $hosts, bot: 0
+          datetime_lt: $until, datetime_geq: $since, requestHost: $host, requestPath_gt: $after,
+          bot: 0
         }
-        limit: 10000
+        limit: $limit
+        orderBy: [requestPath_ASC]
       ) {
         count
         dimensions {
-          requestHost
           requestPath
-        }
-      }
-
-      shortOriginData: rumPageloadEventsAdaptiveGroups(
-        filter: {datetime_lt: $now, datetime_geq: $shortSampling, requestHost_in: $hosts, bot: 0},
-        limit: 10000
-      ) {
-        count
-        dimensions {
-          requestHost
-          date
-        }
-      }
-
-      longOriginData: rumPageloadEventsAdaptiveGroups(
-        filter: {
-          datetime_lt: $shortSampling, datetime_geq: $longSampling, requestHost_in: $hosts, bot: 0
-        },
-        limit: 10000
-      ) {
-        count
-        dimensions {
-          requestHost
           date
         }
       }
@@ -69,6 +42,23 @@ query rumData(
 
 FILTERED_PATHS = ["/", "/admin", "/favicon.ico", "/robots.txt"]
 
+RETENTION_DAYS = 90
+CACHE_TTL = 5 * 60  # seconds
+
+PAGE_SIZE = 10000
+FETCH_CONCURRENCY = 8
+SLICE_DAYS = 7  # Completed days fetched by each query, fewer queries spare the API quota
+
+# (host, path, date) -> count
+Rows = dict[tuple[str, str, str], int]
+# (host, since, until)
+Slice = tuple[str, datetime.datetime, datetime.datetime]
+
+
+def start_of_day(date: datetime.date) -> datetime.datetime:
+    """Return the UTC datetime at which a day starts."""
+    return datetime.datetime.combine(date, datetime.time(), datetime.timezone.utc)
+
 
 class RUMAnalytics(BaseModel):
     """RUM analytics data model."""
@@ -77,72 +67,248 @@ class RUMAnalytics(BaseModel):
     origin_over_time: dict[str, dict[str, int]]
 
 
-async def retrieve_rum_analytics(hosts: list[str]) -> RUMAnalytics:
-    """Retrieve RUM analytics path data for the specified hosts."""
-    if not CLOUDFLARE_ACCOUNT_ID or not CLOUDFLARE_API_TOKEN:
-        raise EnvironmentError("RUM analytics configuration is missing.")
+class Rollup:
+    """Analytics aggregated over a range of days."""
 
-    now = datetime.datetime.now(datetime.timezone.utc)
-    short_sampling = now - datetime.timedelta(days=7)
-    long_sampling = now - datetime.timedelta(days=90)
+    def __init__(self, first_day: datetime.date, last_day: datetime.date) -> None:
+        self.first_day = first_day
+        self.last_day = last_day  # Excluded
 
-    variables = {
-        "accountTag": CLOUDFLARE_ACCOUNT_ID,
-        "now": now.isoformat(),
-        "shortSampling": short_sampling.isoformat(),
-        "longSampling": long_sampling.isoformat(),
-        "hosts": hosts,
-    }
+        self.per_path: dict[str, dict[str, int]] = {}
+        self.origin_over_time: dict[str, dict[str, int]] = {}
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            CLOUDFLARE_GRAPHQL_ENDPOINT,
-            json={"query": DATA_QUERY, "variables": variables},
-            headers={
-                "Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}",
-                "Content-Type": "application/json",
-            },
-        ) as resp:
-            response = await resp.json()
+    def add(self, host: str, path: str, date: str, count: int) -> None:
+        """Add the page loads of a path on a given day."""
+        paths = self.per_path.setdefault(host, {})
+        paths[path] = paths.get(path, 0) + count
+
+        dates = self.origin_over_time.setdefault(host, {})
+        dates[date] = dates.get(date, 0) + count
+
+    def merge(self, rows: Rows) -> RUMAnalytics:
+        """Return the analytics of this rollup, with some more rows on top of it."""
+        per_path = {host: dict(paths) for host, paths in self.per_path.items()}
+        origin_over_time = {host: dict(dates) for host, dates in self.origin_over_time.items()}
 
-    per_path: dict[str, dict[str, int]] = {}
+        for (host, path, date), count in rows.items():
+            paths = per_path.setdefault(host, {})
+            paths[path] = paths.get(path, 0) + count
 
-    short_data = response["data"]["viewer"]["accounts"][0]["shortPathData"]
-    long_data = response["data"]["viewer"]["accounts"][0]["longPathData"]
+            dates = origin_over_time.setdefault(host, {})
+            dates[date] = dates.get(date, 0) + count
 
-    for dataset in (long_data, short_data):
-        for entry in dataset:
-            host = entry["dimensions"]["requestHost"]
-            path = entry["dimensions"]["requestPath"]
-            count = entry["count"]
+        for paths in per_path.values():
+            for path in FILTERED_PATHS:
+                paths.pop(path, None)
 
-            if host not in per_path:
-                per_path[host] = {}
+        return RUMAnalytics(per_path=per_path, origin_over_time=origin_over_time)
 
-            if path not in per_path[host]:
-                per_path[host][path] = 0
 
-            per_path[host][path] += count
+class RUMAnalyticsService:
+    """
+    Retrieves RUM analytics from Cloudflare.
 
-    for host in per_path:
-        for path in FILTERED_PATHS:
-            if path in per_path[host]:
-                del per_path[host][path]
+    Completed days are stored in the DB and only fetched once, so a refresh only has to query
+    the current day. Results are also cached for a few minutes per set of hosts.
+    """
 
-    origin_over_time: dict[str, dict[str, int]] = {}
+    def __init__(self, db_collection: AsyncCollection) -> None:
+        self.db_collection = db_collection
+        self.session: aiohttp.ClientSession | None = None
 
-    short_origin_data = response["data"]["viewer"]["accounts"][0]["shortOriginData"]
-    long_origin_data = response["data"]["viewer"]["accounts"][0]["longOriginData"]
+        self.rollups: dict[tuple[str, ...], Rollup] = {}
+        self.cache: dict[tuple[str, ...], tuple[float, RUMAnalytics]] = {}
 
-    for dataset in (long_origin_data, short_origin_data):
-        for entry in dataset:
-            host = entry["dimensions"]["requestHost"]
-            date = entry["dimensions"]["date"]
-            count = entry["count"]
+    async def create_indexes(self) -> None:
+        """Create the indexes of the daily analytics, expiring them after the retention period."""
+        await self.db_collection.create_index([("host", 1), ("date", 1)], unique=True)
+        await self.db_collection.create_index(
+            "stored_at", expireAfterSeconds=(RETENTION_DAYS + 1) * 24 * 60 * 60
+        )
 
-            if host not in origin_over_time:
-                origin_over_time[host] = {}
+    async def close(self) -> None:
+        """Close the HTTP session."""
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def retrieve(self, hosts: list[str]) -> RUMAnalytics:
+        """Retrieve RUM analytics path data for the specified hosts."""
+        if not CLOUDFLARE_ACCOUNT_ID or not CLOUDFLARE_API_TOKEN:
+            raise EnvironmentError("RUM analytics configuration is missing.")
+
+        key = tuple(sorted(set(hosts)))
+
+        cached = self.cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        today = now.date()
+
+        rollup = await self._get_rollup(key, today - datetime.timedelta(days=RETENTION_DAYS), today)
+        today_rows = await self._fetch([(host, start_of_day(today), now) for host in key])
+        analytics = rollup.merge(today_rows)
+
+        self.cache[key] = (time.monotonic() + CACHE_TTL, analytics)
+        return analytics
+
+    async def _get_rollup(
+        self, hosts: tuple[str, ...], first_day: datetime.date, last_day: datetime.date
+    ) -> Rollup:
+        """Get the rollup of the completed days, fetching the days that aren't stored yet."""
+        rollup = self.rollups.get(hosts)
+        if rollup and rollup.first_day == first_day and rollup.last_day == last_day:
+            return rollup
+
+        days = {(first_day + datetime.timedelta(days=i)).isoformat() for i in range(RETENTION_DAYS)}
+        stored: dict[tuple[str, str], list] = {}
+
+        async for document in self.db_collection.find(
+            {"host": {"$in": list(hosts)}, "date": {"$gte": first_day.isoformat()}}
+        ):
+            if document["date"] in days:
+                stored[document["host"], document["date"]] = document["paths"]
+
+        # Missing days are fetched by week, each week being stored as soon as it is fetched
+        weeks: dict[tuple[str, int], list[datetime.date]] = {}
+        for date in sorted(days):
+            for host in hosts:
+                if (host, date) not in stored:
+                    day = datetime.date.fromisoformat(date)
+                    weeks.setdefault((host, (day - first_day).days // SLICE_DAYS), []).append(day)
+
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+        results = await asyncio.gather(
+            *(self._fetch_days(semaphore, host, week) for (host, _), week in weeks.items()),
+            return_exceptions=True,
+        )
+
+        complete = True
+        for result in results:
+            if isinstance(result, BaseException):
+                logging.error("Failed to fetch analytics.", exc_info=result)
+                complete = False
+            else:
+                stored.update(result)
+
+        rollup = Rollup(first_day, last_day)
+        for (host, date), paths in stored.items():
+            for path, count in paths:
+                rollup.add(host, path, date, count)
+
+        # Otherwise, the days that failed are fetched again on the next load
+        if complete:
+            self.rollups[hosts] = rollup
+        return rollup
+
+    async def _fetch_days(
+        self, semaphore: asyncio.Semaphore, host: str, days: list[datetime.date]
+    ) -> dict[tuple[str, str], list]:
+        """Fetch and store the path data of some completed days of a host, in a single slice."""
+        rows: Rows = {}
+        since = start_of_day(days[0])
+        until = start_of_day(days[-1] + datetime.timedelta(days=1))
+        await self._fetch_slice(semaphore, rows, host, since, until)
+
+        # Every fetched day is stored, even when empty, so we never fetch it again
+        daily_paths: dict[tuple[str, str], list] = {(host, day.isoformat()): [] for day in days}
+        for (_, path, date), count in rows.items():
+            if (host, date) in daily_paths:
+                daily_paths[host, date].append([path, count])
+
+        await self._store(daily_paths)
+        return daily_paths
+
+    async def _store(self, daily_paths: dict[tuple[str, str], list]) -> None:
+        """Store the path data of completed days."""
+        stored_at = datetime.datetime.now(datetime.timezone.utc)
+        await self.db_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"host": host, "date": date},
+                    {"$set": {"paths": paths, "stored_at": stored_at}},
+                    upsert=True,
+                )
+                for (host, date), paths in daily_paths.items()
+            ],
+            ordered=False,
+        )
+
+    async def _fetch(self, slices: list[Slice]) -> Rows:
+        """
+        Fetch the page loads per host, path and day of each slice.
+
+        Slices are fetched concurrently, and their results are aggregated as they arrive.
+        """
+        rows: Rows = {}
+        semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+        await asyncio.gather(
+            *(self._fetch_slice(semaphore, rows, *time_slice) for time_slice in slices)
+        )
+        return rows
+
+    async def _fetch_slice(
+        self,
+        semaphore: asyncio.Semaphore,
+        rows: Rows,
+        host: str,
+        since: datetime.datetime,
+        until: datetime.datetime,
+    ) -> None:
+        """Fetch every page of results of a slice, adding them to the rows as they arrive."""
+        after = ""
+
+        while True:
+            async with semaphore:
+                entries = await self._query(
+                    {
+                        "accountTag": CLOUDFLARE_ACCOUNT_ID,
+                        "since": since.isoformat(),
+                        "until": until.isoformat(),
+                        "host": host,
+                        "after": after,
+                        "limit": PAGE_SIZE,
+                    }
+                )
+
+            is_last_page = len(entries) < PAGE_SIZE
+            if not is_last_page:
+                # A path has a group per day, the ones of the last path may go on in the next
+                # page, so that path is fetched again in full with the next page
+                last_path = entries[-1]["dimensions"]["requestPath"]
+                complete_entries = [
+                    entry for entry in entries if entry["dimensions"]["requestPath"] != last_path
+                ]
+                if complete_entries:
+                    entries = complete_entries
+
+            for entry in entries:
+                dimensions = entry["dimensions"]
+                key = (host, dimensions["requestPath"], dimensions["date"])
+                rows[key] = rows.get(key, 0) + entry["count"]
+
+            if is_last_page:
+                return
+            after = entries[-1]["dimensions"]["requestPath"]
+
+    async def _query(self, variables: dict) -> list[dict]:
+        """Run the data query with the given variables, and return its groups."""
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                headers={
+                    "Authorization": f"Bearer {CLOUDFLARE_API_TOKEN}",
+                    "Content-Type": "application/json",
+                }
+            )
+
+        async with self.session.post(
+            CLOUDFLARE_GRAPHQL_ENDPOINT, json={"query": DATA_QUERY, "variables": variables}
+        ) as resp:
+            response = await resp.json()
 
-            origin_over_time[host][date] = count
+        if response.get("errors"):
+            raise RuntimeError(f"Cloudflare analytics query failed: {response['errors']}")
 
-    return RUMAnalytics(per_path=per_path, origin_over_time=origin_over_time)
+        return response["data"]["viewer"]["accounts"][0]["pathData"]
@@ -0,0 +1,267 @@
+import datetime
+import math
+import sys
+import time
+from abc import ABC, abstractmethod
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from pymongo.asynchronous.collection import AsyncCollection
+from starlette.requests import Request
+
+from backend.utils import PrunableDict, get_remote_address
+
+
+class RateWindow:
+    """
+    A sliding window counter, approximated from the counts of the current and previous windows.
+
+    It takes a fixed amount of memory however many hits it counts.
+    """
+
+    __slots__ = ("length", "index", "current", "previous")
+
+    def __init__(self, length: float) -> None:
+        self.length = length
+        self.index = 0
+        self.current = 0
+        self.previous = 0
+
+    def hit(self, now: float) -> float:
+        """Count a hit, and return the estimated number of hits over the last window length."""
+        index = int(now // self.length)
+        if index != self.index:
+            self.previous = self.current if index == self.index + 1 else 0
+            self.current = 0
+            self.index = index
+
+        self.current += 1
+        return estimate(self.previous, self.current, now, self.length)
+
+    def is_expired(self) -> bool:
+        """Check if the previous window has ended, so there is no hit left to count."""
+        return time.time() >= self.expiration_time()
+
+    def expiration_time(self) -> float:
+        """Return the timestamp at which the hits of the current window stop counting."""
+        return (self.index + 2) * self.length
+
+    def is_pinned(self) -> bool:
+        """Counters can always be evicted, at worst a client gets a few more hits."""
+        return False
+
+
+class Ban:
+    """A ban of a client, until a given time."""
+
+    __slots__ = ("until",)
+
+    def __init__(self, until: float) -> None:
+        self.until = until
+
+    def is_expired(self) -> bool:
+        """Check if the ban is over."""
+        return time.time() >= self.until
+
+    def expiration_time(self) -> float:
+        """Return the timestamp at which the ban is over."""
+        return self.until
+
+    def is_pinned(self) -> bool:
+        """Bans can be evicted, but only when the store is full of more recent entries."""
+        return False
+
+
+def estimate(previous: int, current: int, now: float, length: float) -> float:
+    """Estimate the hits over the last window length, assuming the previous ones were uniform."""
+    elapsed = now / length - now // length
+    return previous * (1 - elapsed) + current
+
+
+def retry_after(now: float, length: float) -> float:
+    """Return the time in seconds until the current window ends."""
+    return length - now % length
+
+
+class ClientStateStore(ABC):
+    """
+    Keeps the per-client state used to ban and rate limit clients.
+
+    Every entry expires on its own, so the state of clients that went away doesn't pile up.
+    """
+
+    @abstractmethod
+    async def hit(self, key: str, limit: int, length: float) -> float | None:
+        """
+        Count a hit of a client, limited to `limit` hits per `length` seconds.
+
+        Return None if the hit is allowed, or the time in seconds to wait before retrying.
+        Refused hits are counted too, so clients that keep hammering stay limited.
+        """
+
+    @abstractmethod
+    async def ban(self, key: str, duration: float) -> None:
+        """Ban a client for the given duration in seconds."""
+
+    @abstractmethod
+    async def is_banned(self, key: str) -> bool:
+        """Check if a client is currently banned."""
+
+    async def create_indexes(self) -> None:  # noqa: B027 - only stores in a DB need indexes
+        """Create the indexes the store relies on, if any."""
+
+    def prune(self, max_items: int | None = None) -> bool:
+        """Remove expired entries, returning True if there are still some to go through."""
+        return False
+
+    @abstractmethod
+    async def stats(self) -> dict:
+        """Return the number of entries of the store, and the memory they take."""
+
+
+class InMemoryClientStateStore(ClientStateStore):
+    """A client state store local to this replica, evicting the least recently used clients."""
+
+    def __init__(self, max_size: int) -> None:
+        self.entries: PrunableDict[str, RateWindow | Ban] = PrunableDict(max_size, "client_state")
+
+    async def hit(self, key: str, limit: int, length: float) -> float | None:
+        """Count a hit of a client in its window counter."""
+        window = self.entries.get(key)
+        if window is None:
+            window = self.entries[key] = RateWindow(length)
+
+        now = time.time()
+        if window.hit(now) > limit:
+            return retry_after(now, length)
+        return None
+
+    async def ban(self, key: str, duration: float) -> None:
+        """Ban a client for the given duration."""
+        self.entries[f"ban:{key}"] = Ban(time.time() + duration)
+
+    async def is_banned(self, key: str) -> bool:
+        """Check if a client has a ban that isn't over."""
+        return self.entries.get(f"ban:{key}") is not None
+
+    def prune(self, max_items: int | None = None) -> bool:
+        """Remove the windows and bans that are over."""
+        return self.entries.prune(max_items)
+
+    async def stats(self) -> dict:
+        """Return the number of entries, and an estimate of the memory they take in bytes."""
+        size = self.entries.container_size()
+        for key, entry in self.entries.items():
+            size += sys.getsizeof(key) + sys.getsizeof(entry)
+
+        return {
+            "backend": "memory",
+            "entries": len(self.entries),
+            "max_entries": self.entries.max_size,
+            "size": size,
+        }
+
+
+class MongoClientStateStore(ClientStateStore):
+    """A client state store shared by every replica, in a MongoDB collection with a TTL."""
+
+    def __init__(self, db_collection: AsyncCollection) -> None:
+        self.db_collection = db_collection
+
+    async def hit(self, key: str, limit: int, length: float) -> float | None:
+        """Count a hit of a client in its window counter, atomically."""
+        now = time.time()
+        index = int(now // length)
+        expires_at = datetime.datetime.fromtimestamp((index + 2) * length, datetime.timezone.utc)
+
+        # Within a $set stage, fields refer to the document as it was before the update
+        window = await self.db_collection.find_one_and_update(
+            {"_id": key},
+            [
+                {
+                    "$set": {
+                        "previous": {
+                            "$switch": {
+                                "branches": [
+                                    {"case": {"$eq": ["$index", index]}, "then": "$previous"},
+                                    {"case": {"$eq": ["$index", index - 1]}, "then": "$current"},
+                                ],
+                                "default": 0,
+                            }
+                        },
+                        "current": {
+                            "$cond": [
+                                {"$eq": ["$index", index]},
+                                {"$add": ["$current", 1]},
+                                1,
+                            ]
+                        },
+                        "index": index,
+                        "expires_at": expires_at,
+                    }
+                }
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+
+        if estimate(window["previous"], window["current"], now, length) > limit:
+            return retry_after(now, length)
+        return None
+
+    async def ban(self, key: str, duration: float) -> None:
+        """Ban a client for the given duration."""
+        until = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=duration)
+        await self.db_collection.replace_one(
+            {"_id": f"ban:{key}"}, {"expires_at": until}, upsert=True
+        )
+
+    async def is_banned(self, key: str) -> bool:
+        """Check if a client has a ban that isn't over, the TTL monitor only runs every minute."""
+        ban = await self.db_collection.find_one(
+            {
+                "_id": f"ban:{key}",
+                "expires_at": {"$gt": datetime.datetime.now(datetime.timezone.utc)},
+            }
+        )
+        return ban is not None
+
+    async def create_indexes(self) -> None:
+        """Create the TTL index removing entries once they are over."""
+        await self.db_collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def stats(self) -> dict:
+        """Return the number of entries, and the size of the collection in bytes."""
+        size = None
+        async for collection_stats in await self.db_collection.aggregate(
+            [{"$collStats": {"storageStats": {}}}]
+        ):
+            size = collection_stats["storageStats"]["size"]
+
+        return {
+            "backend": "mongodb",
+            "entries": await self.db_collection.estimated_document_count(),
+            "size": size,
+        }
+
+
+class RateLimit:
+    """A dependency limiting how many times each client can call an endpoint."""
+
+    def __init__(self, store: ClientStateStore, name: str, limit: int, length: float) -> None:
+        self.store = store
+        self.name = name
+        self.limit = limit
+        self.length = length
+
+    async def __call__(self, request: Request) -> None:
+        """Count the request, and refuse it if the client is over the limit."""
+        key = f"{self.name}:{get_remote_address(request)}"
+        wait = await self.store.hit(key, self.limit, self.length)
+
+        if wait is not None:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Rate limit exceeded: {self.limit} per {self.length:g} seconds",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
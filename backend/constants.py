@@ -25,4 +25,36 @@ CLOUDFLARE_ACCOUNT_ID = os.environ.get("CLOUDFLARE_ACCOUNT_ID")
 CLOUDFLARE_API_TOKEN = os.environ.get("CLOUDFLARE_API_TOKEN")
 
 EXPIRATION = 7 * 24 * 60 * 60  # 7 days in seconds
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 10_000))
+PRUNE_INTERVAL = 10  # seconds
+PRUNE_SLICE_SIZE = 1000
+MAX_BATCH_SIZE = 100  # operations in a single batch of timer operations
+# How long shared caches may serve a public page without checking it is up-to-date, in seconds
+PUBLIC_PAGE_MAX_AGE = int(os.environ.get("PUBLIC_PAGE_MAX_AGE", 5))
+UPDATE_BUS = os.environ.get("UPDATE_BUS", "memory")  # "memory" or "mongodb"
+CLIENT_STATE_STORE = os.environ.get("CLIENT_STATE_STORE", "memory")  # "memory" or "mongodb"
+CLIENT_STATE_SIZE = int(os.environ.get("CLIENT_STATE_SIZE", 100_000))
+PERSISTENCE_INTERVAL = float(os.environ.get("PERSISTENCE_INTERVAL", 1))  # seconds
+# Messages are compressed once for every subscriber using the chrono.msgpack.deflate subprotocol,
+# level 0 turns it off. The window is 2**bits bytes, from 9 to 15 bits. Payloads smaller than the
+# threshold in bytes are sent uncompressed. See benchmarks.compression to pick them.
+WS_COMPRESSION_LEVEL = int(os.environ.get("WS_COMPRESSION_LEVEL", 6))
+WS_COMPRESSION_WINDOW_BITS = int(os.environ.get("WS_COMPRESSION_WINDOW_BITS", 15))
+WS_COMPRESSION_THRESHOLD = int(os.environ.get("WS_COMPRESSION_THRESHOLD", 256))
+# permessage-deflate of the websocket server compresses every frame once per connection,
+# including the already compressed frames of chrono.msgpack.deflate, so it is off by default
+# unless the subprotocol compression is turned off
+WS_PER_MESSAGE_DEFLATE = (
+    os.environ.get("WS_PER_MESSAGE_DEFLATE", str(WS_COMPRESSION_LEVEL <= 0)).lower() == "true"
+)
+# Pages are sharded across this many worker processes, see backend.workers
+WORKER_COUNT = int(os.environ.get("WORKERS", 1))
+WORKER_INDEX = int(os.environ.get("WORKER_INDEX", 0))
+WORKER_SOCKET_DIR = os.environ.get("WORKER_SOCKET_DIR", "/tmp/chrono-workers")
+SHARD_TOKEN = os.environ.get("SHARD_TOKEN", "")
+# New websockets accepted per second by each worker, 0 turns admission control off. The rates
+# start at a tenth of these after startup, and ramp up during the warm-up, in seconds.
+SUBSCRIBE_ADMISSION_RATE = float(os.environ.get("SUBSCRIBE_ADMISSION_RATE", 200))
+TIME_ADMISSION_RATE = float(os.environ.get("TIME_ADMISSION_RATE", 500))
+ADMISSION_WARMUP = float(os.environ.get("ADMISSION_WARMUP", 30))
 CLOUDFLARE_GRAPHQL_ENDPOINT = "https://api.cloudflare.com/client/v4/graphql"
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import suppress
+from typing import TYPE_CHECKING, Awaitable, Callable
+
+from backend.metrics import registry
+
+if TYPE_CHECKING:
+    from backend.timer import Timer
+
+FIRE_BATCH_SIZE = 1000
+# Past this many stale entries, the heap is rebuilt rather than left to drain at their deadlines
+MAX_STALE_ENTRIES = 10_000
+
+FINISHED_TIMERS = registry.counter("chrono_finished_timers_total", "Running timers reaching zero")
+
+# Called with a timer that reached zero, its index in its page and its deadline
+FinishedHandler = Callable[["Timer", int, float], Awaitable[None]]
+
+
+class DeadlineScheduler:
+    """
+    Tracks when running timers reach zero, and calls handlers at that moment.
+
+    Deadlines are kept in a heap watched by a single task, sleeping until the next one. Like in
+    PrunableDict, timers scheduled again leave a stale heap entry behind that is skipped.
+    """
+
+    def __init__(self) -> None:
+        self._heap: list[tuple[float, int, Timer]] = []
+        self._scheduled: dict[Timer, float] = {}  # Only the heap entry matching this time is valid
+        self._counter = itertools.count()  # Tie-breaker, so timers are never compared
+
+        self.handlers: list[FinishedHandler] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        """Return the number of scheduled timers."""
+        return len(self._scheduled)
+
+    def __contains__(self, timer: Timer) -> bool:
+        """Check if a timer is waiting for its deadline."""
+        return timer in self._scheduled
+
+    def subscribe(self, handler: FinishedHandler) -> None:
+        """Register a handler called whenever a timer reaches zero."""
+        self.handlers.append(handler)
+
+    def update(self, timer: Timer) -> None:
+        """Schedule, reschedule or unschedule a timer after it changed."""
+        deadline = timer.deadline()
+        if deadline is None:
+            self._scheduled.pop(timer, None)
+            return
+
+        if self._scheduled.get(timer) == deadline:
+            return
+        self._scheduled[timer] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), timer))
+
+        if len(self._heap) - len(self._scheduled) > MAX_STALE_ENTRIES:
+            self._heap = [
+                (deadline, next(self._counter), timer)
+                for timer, deadline in self._scheduled.items()
+            ]
+            heapq.heapify(self._heap)
+
+        if self._heap[0][2] is timer:
+            self._wakeup.set()  # The task sleeps until a later deadline
+
+    def remove(self, timer: Timer) -> None:
+        """Unschedule a timer that no longer exists."""
+        self._scheduled.pop(timer, None)
+
+    async def start(self) -> None:
+        """Start watching the deadlines."""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop watching the deadlines."""
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+
+    async def _run(self) -> None:
+        """Fire the due deadlines, then sleep until the next one or until an earlier one comes."""
+        while True:
+            self._wakeup.clear()
+            await self.fire_due()
+
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+
+    async def fire_due(self) -> None:
+        """Call the handlers of every timer whose deadline has passed."""
+        heap = self._heap
+        fired = 0
+
+        while heap and heap[0][0] <= time.time():
+            deadline, _, timer = heapq.heappop(heap)
+            if self._scheduled.get(timer) != deadline:
+                continue  # Stale entry, the timer was paused or scheduled again
+            del self._scheduled[timer]
+
+            try:
+                index = timer.page.timers.index(timer)
+            except ValueError:
+                continue  # The timer was deleted, or its page reloaded
+
+            FINISHED_TIMERS.inc()
+            for handler in self.handlers:
+                try:
+                    await handler(timer, index, deadline)
+                except Exception:
+                    logging.exception("Failed to handle a finished timer.")
+
+            fired += 1
+            if fired % FIRE_BATCH_SIZE == 0:
+                await asyncio.sleep(0)  # Let other tasks run between batches
@@ -1,105 +1,212 @@
 import asyncio
-import datetime
 import json
 import logging
 import time
-from contextlib import asynccontextmanager
-from typing import Any, AsyncGenerator
+from contextlib import asynccontextmanager, suppress
+from typing import Annotated, Any, AsyncGenerator
 
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import Depends, FastAPI, HTTPException, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from fastapi_utils.tasks import repeat_every
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from pymongo import AsyncMongoClient
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
 from starlette.requests import Request
-from starlette.responses import JSONResponse
-from websockets import ConnectionClosed
-
-from backend.analytics import RUMAnalytics, retrieve_rum_analytics
+from starlette.responses import JSONResponse, PlainTextResponse
+
+from backend.admin_index import (
+    SortField,
+    SortOrder,
+    backfill_index_fields,
+    create_admin_indexes,
+    index_stats,
+    query_index,
+)
+from backend.admission import AdmissionControl, shed
+from backend.analytics import RUMAnalytics, RUMAnalyticsService
+from backend.client_state import (
+    ClientStateStore,
+    InMemoryClientStateStore,
+    MongoClientStateStore,
+    RateLimit,
+)
 from backend.constants import (
     ADMIN_PASSWORD_HASH,
+    ADMISSION_WARMUP,
+    CLIENT_STATE_SIZE,
+    CLIENT_STATE_STORE,
     DEVELOPMENT,
     EXPIRATION,
     FAILED_PASSWORD_BAN,
     GIT_SHA,
+    MAX_BATCH_SIZE,
     MONGO_DATABASE,
     MONGO_URI,
+    PAGE_CACHE_SIZE,
+    PERSISTENCE_INTERVAL,
+    PRUNE_INTERVAL,
+    PRUNE_SLICE_SIZE,
+    PUBLIC_PAGE_MAX_AGE,
+    SHARD_TOKEN,
+    SUBSCRIBE_ADMISSION_RATE,
+    TIME_ADMISSION_RATE,
+    UPDATE_BUS,
+    WORKER_COUNT,
+    WORKER_INDEX,
 )
+from backend.deadlines import DeadlineScheduler
 from backend.lang import get_locale_from_request
-from backend.timer import Timer, TimerPage
-from backend.utils import PrunableDict, get_remote_address, sha256
+from backend.messages import Message
+from backend.metrics import registry
+from backend.page_store import PageStore
+from backend.persistence import PageFlusher
+from backend.sharding import Forwarder, HashRing, ShardRouter
+from backend.time_sync import SyncClock, reply
+from backend.timer import PageContext, Timer, TimerAction, TimerPage
+from backend.update_bus import InMemoryUpdateBus, MongoUpdateBus, PageUpdate, UpdateBus
+from backend.utils import etag_matches, get_remote_address, sha256
 from backend.websocket_manager import WebsocketManager
 
-edit_links: PrunableDict[str, TimerPage] = PrunableDict()
-public_links: PrunableDict[str, TimerPage] = PrunableDict()
 websocket_manager = WebsocketManager()
-last_failed_password_entry: dict[str, datetime.datetime] = {}
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)-10s%(message)s")
 logging.info("Launching version %s", GIT_SHA)
 
 client = AsyncMongoClient(MONGO_URI)
 collection = client[MONGO_DATABASE].pages
+page_flusher = PageFlusher(collection)
+rum_analytics = RUMAnalyticsService(client[MONGO_DATABASE].rum_daily)
+
+update_bus: UpdateBus
+if UPDATE_BUS == "mongodb":
+    update_bus = MongoUpdateBus(client[MONGO_DATABASE].page_updates)
+else:
+    update_bus = InMemoryUpdateBus()
+
+client_state: ClientStateStore
+if CLIENT_STATE_STORE == "mongodb":
+    client_state = MongoClientStateStore(client[MONGO_DATABASE].client_state)
+else:
+    client_state = InMemoryClientStateStore(CLIENT_STATE_SIZE)
+
+deadlines = DeadlineScheduler()
+
+page_context = PageContext(websocket_manager, page_flusher, update_bus, deadlines)
+page_store = PageStore(page_context, collection, PAGE_CACHE_SIZE)
+
+shard_ring = HashRing(WORKER_COUNT)
+forwarder = Forwarder(SHARD_TOKEN)
+
+subscribe_admission = AdmissionControl("subscribe", SUBSCRIBE_ADMISSION_RATE, ADMISSION_WARMUP)
+time_admission = AdmissionControl("time", TIME_ADMISSION_RATE, ADMISSION_WARMUP)
+
+# Sizes are read when scraped, so they cost nothing on the hot paths
+CACHED_PAGES = registry.gauge("chrono_cached_pages", "Pages loaded in memory", ("cache",))
+CACHED_PAGES.labels("edit_links").set_function(page_store.edit_links.__len__)
+CACHED_PAGES.labels("public_links").set_function(page_store.public_links.__len__)
+registry.gauge("chrono_subscribed_pages", "Pages with websocket subscribers").set_function(
+    websocket_manager.connections.__len__
+)
+registry.gauge(
+    "chrono_max_page_subscribers", "Websocket subscribers of the most subscribed page"
+).set_function(lambda: max(websocket_manager.subscriber_counts(), default=0))
+registry.gauge("chrono_scheduled_timers", "Running timers waiting for their deadline").set_function(
+    deadlines.__len__
+)
+registry.gauge("chrono_pending_pages", "Modified pages waiting to be persisted").set_function(
+    lambda: len(page_flusher.dirty)
+)
+registry.gauge(
+    "chrono_persistence_lag_seconds", "Age of the oldest unpersisted change"
+).set_function(lambda: page_flusher.lag)
+PRUNE_PASS_SECONDS = registry.histogram(
+    "chrono_prune_pass_seconds", "Time taken by a full pruning pass, pauses between slices included"
+)
 
 
-async def create_tld_index() -> None:
-    """Create the mongodb index that gives our storage a TTL."""
-    await collection.create_index("last_modified", expireAfterSeconds=EXPIRATION)
+async def on_page_update(update: PageUpdate) -> None:
+    """Apply updates coming from other replicas, and send all updates to our subscribers."""
+    message = update.message
 
+    if update.replica != update_bus.replica_id:
+        # Pages that aren't loaded have no subscribers, they will be loaded fresh when needed
+        page = page_store.get_cached(update.public_link, update.edit_link)
+        if page is None:
+            return
+
+        message = page.apply_remote_update(update)
+        if message is None:
+            page_store.reload_later(page, update.version)
+            return
+
+    websocket_manager.broadcast_update(update.public_link, message)
+
+
+update_bus.subscribe(on_page_update)
+
+
+async def on_timer_finished(timer: Timer, index: int, deadline: float) -> None:
+    """
+    Let our subscribers know that a timer reached zero.
+
+    Every replica with the page loaded schedules its timers, so each one only tells its own
+    subscribers. The event doesn't change the page, its version stays the same.
+    """
+    page = timer.page
+    message = Message(
+        {
+            "type": "finished",
+            "version": page.version,
+            "revision": page.revision,
+            "index": index,
+            "deadline": deadline,
+        }
+    )
+    websocket_manager.broadcast_update(page.public_link, message)
 
-async def reload_data() -> None:
-    """Reload data from the DB."""
-    async for document in collection.find():
-        timers = []
-
-        page = TimerPage(
-            websocket_manager,
-            collection,
-            timers=timers,
-            public_link=document["public_link"],
-            edit_link=document["edit_link"],
-            name=document["name"],
-            color=document["color"],
-            last_modified=datetime.datetime.fromisoformat(document["last_modified"]),
-            origin=document.get("origin", "unknown://"),
-        )
 
-        for timer in document["timers"]:
-            timers.append(
-                Timer(
-                    -1,  # doesn't matter as we override all the other attributes
-                    page,
-                    websocket_manager,
-                    unpaused_time=timer["unpaused_time"],
-                    remaining_duration=timer["remaining_duration"],
-                    is_paused=timer["is_paused"],
-                    full_duration=timer["full_duration"],
-                    name=timer["name"],
-                )
-            )
-        page.timers = timers
-
-        edit_links[document["edit_link"]] = page
-        public_links[document["public_link"]] = page
+deadlines.subscribe(on_timer_finished)
+
+
+async def create_tld_index() -> None:
+    """Create the mongodb index that gives our storage a TTL."""
+    await collection.create_index("last_modified", expireAfterSeconds=EXPIRATION)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, Any]:
     """Run code during the lifespan of our app."""
     await create_tld_index()
-    await reload_data()
+    await backfill_index_fields(collection)
+    await create_admin_indexes(collection)
+    await page_store.create_indexes()
+    await update_bus.start()
+    await rum_analytics.create_indexes()
+    await client_state.create_indexes()
+    await deadlines.start()
     await remove_expired_entries()  # Start the periodic task to prune expired entries
+    await send_heartbeats()  # Start the periodic task to send heartbeats to subscribers
+    await flush_pages()  # Start the periodic task to persist modified pages
+    subscribe_admission.start()
+    time_admission.start()
     app.state.ready = True
     logging.info("App is ready to receive requests.")
     yield
     logging.warning("Shutting down application.")
     app.state.ready = False
-
-
-limiter = Limiter(key_func=get_remote_address)
-app = FastAPI(lifespan=lifespan, docs_url="/docs" if DEVELOPMENT else None, redoc_url=None)
+    await update_bus.stop()
+    await deadlines.stop()
+    await rum_analytics.close()
+    await forwarder.close()
+    await page_flusher.flush()
+
+
+app = FastAPI(
+    lifespan=lifespan,
+    docs_url="/docs" if DEVELOPMENT else None,
+    redoc_url=None,
+    default_response_class=ORJSONResponse,
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -107,8 +214,14 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+if WORKER_COUNT > 1:
+    app.add_middleware(
+        ShardRouter,
+        ring=shard_ring,
+        worker=WORKER_INDEX,
+        forwarder=forwarder,
+        resolve=page_store.find_public_link,
+    )
 
 
 class NewTimer(BaseModel):
@@ -117,6 +230,20 @@ class NewTimer(BaseModel):
     duration: float
 
 
+class TimerOperation(BaseModel):
+    """Model for an operation of a batch, applied to some timers or all of them."""
+
+    action: TimerAction
+    timers: list[int] | None = None
+    seconds: float = 0
+
+
+class TimerBatch(BaseModel):
+    """Model for operations applied to the timers of a page at once."""
+
+    operations: list[TimerOperation] = Field(max_items=MAX_BATCH_SIZE)
+
+
 class ModifyPageSettings(BaseModel):
     """Model for modifying page settings."""
 
@@ -124,47 +251,96 @@ class ModifyPageSettings(BaseModel):
     color: str
 
 
-@repeat_every(seconds=3600)  # 1 hour
+@repeat_every(seconds=PRUNE_INTERVAL)
 async def remove_expired_entries() -> None:
-    """Remove expired entries from the edit and public links."""
-    edit_links.prune()
-    public_links.prune()
+    """Remove expired pages and client state, a slice at a time."""
+    start = time.perf_counter()
+    while page_store.prune(PRUNE_SLICE_SIZE):
+        await asyncio.sleep(0)  # Let other tasks run between slices
+
+    while client_state.prune(PRUNE_SLICE_SIZE):
+        await asyncio.sleep(0)
+    PRUNE_PASS_SECONDS.observe(time.perf_counter() - start)
 
 
-@app.post("/page/new")
-@limiter.limit("5/minute")
+@repeat_every(seconds=websocket_manager.heartbeat.tick_interval)
+async def send_heartbeats() -> None:
+    """Send a heartbeat to the websocket subscribers whose turn it is."""
+    await websocket_manager.heartbeat.tick()
+
+
+@repeat_every(seconds=PERSISTENCE_INTERVAL)
+async def flush_pages() -> None:
+    """Persist the pages modified since the last flush."""
+    await page_flusher.flush()
+
+
+@app.post("/page/new", dependencies=[Depends(RateLimit(client_state, "new_page", 5, 60))])
 async def new_page(request: Request) -> dict:
     """Create a new page."""
     locale = get_locale_from_request(request)
     origin = request.headers.get("Origin", "unknown://")
 
-    page = TimerPage(websocket_manager, collection, name=locale.default_page_name, origin=origin)
+    # Both links hash to this worker, so it owns the page even before it is persisted
+    page = TimerPage(
+        page_context,
+        public_link=shard_ring.random_key(WORKER_INDEX),
+        edit_link=shard_ring.random_key(WORKER_INDEX),
+        name=locale.default_page_name,
+        origin=origin,
+    )
     await page.save()
+    page_store.add(page)
 
-    edit_links[page.edit_link] = page
-    public_links[page.public_link] = page
+    # Other replicas load pages from the DB, and the client opens the page right away
+    await page_flusher.persist(page)
 
     return {"edit_link": page.edit_link}
 
 
-@app.get("/page/{link}")
-@limiter.limit("10/minute")
-async def get_page(link: str, request: Request) -> dict:
+def page_response(request: Request, page: TimerPage, permissions: str) -> Response:
+    """
+    Respond with a page, or with 304 if the client already has its current version.
+
+    Public pages can be cached by shared caches for a little while, edit links are secret so
+    they are only cached by clients, which have to revalidate them.
+    """
+    # The ETag is a hash of the snapshot rather than the version, versions lost before a flush
+    # are numbered again after a restart. The deployed version is part of it, in case the
+    # format of the response changes.
+    snapshot = page.snapshot()
+    etag = f'"{snapshot.digest()}-{GIT_SHA[:12]}"'
+    if permissions == "public":
+        cache_control = f"public, max-age=0, s-maxage={PUBLIC_PAGE_MAX_AGE}"
+    else:
+        cache_control = "private, no-cache"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    # The snapshot holds the JSON of the page, only built once per version
+    content = {"page": snapshot.data["page"], "permissions": permissions}
+    return ORJSONResponse(content, headers=headers)
+
+
+@app.get("/page/{link}", dependencies=[Depends(RateLimit(client_state, "get_page", 10, 60))])
+async def get_page(link: str, request: Request) -> Response:
     """Get a timer page by its link."""
-    public_page = public_links.get(link)
+    public_page = await page_store.get_by_public_link(link)
     if public_page:
-        return {"page": public_page.to_json(), "permissions": "public"}
+        return page_response(request, public_page, "public")
 
-    edit_page = edit_links.get(link)
+    edit_page = await page_store.get_by_edit_link(link)
     if edit_page:
-        return {"page": edit_page.to_json(), "permissions": "edit"}
+        return page_response(request, edit_page, "edit")
 
     raise HTTPException(status_code=404, detail="Page not found")
 
 
-def find_timer(edit_link: str, number: int) -> Timer:
+async def find_timer(edit_link: str, number: int) -> Timer:
     """Find a timer by its edit link and number."""
-    page = edit_links.get(edit_link)
+    page = await page_store.get_by_edit_link(edit_link)
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
 
@@ -177,25 +353,28 @@ def find_timer(edit_link: str, number: int) -> Timer:
 @app.post("/timer/{edit_link}/{number}/start", status_code=204)
 async def start_timer(edit_link: str, number: int) -> None:
     """Start a timer by its edit link and number."""
-    await find_timer(edit_link, number).start()
+    timer = await find_timer(edit_link, number)
+    await timer.start()
 
 
 @app.post("/timer/{edit_link}/{number}/pause", status_code=204)
 async def pause_timer(edit_link: str, number: int) -> None:
     """Pause a timer by its edit link and number."""
-    await find_timer(edit_link, number).pause()
+    timer = await find_timer(edit_link, number)
+    await timer.pause()
 
 
 @app.post("/timer/{edit_link}/{number}/reset", status_code=204)
 async def reset_timer(edit_link: str, number: int) -> None:
     """Reset a timer by its edit link and number."""
-    await find_timer(edit_link, number).reset()
+    timer = await find_timer(edit_link, number)
+    await timer.reset()
 
 
 @app.delete("/timer/{edit_link}/{number}", status_code=204)
 async def delete_timer(edit_link: str, number: int) -> None:
     """Delete a timer by its edit link and number."""
-    page = edit_links.get(edit_link)
+    page = await page_store.get_by_edit_link(edit_link)
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
 
@@ -208,19 +387,37 @@ async def delete_timer(edit_link: str, number: int) -> None:
 @app.post("/timer/{edit_link}/{number}/add_time/{seconds}", status_code=204)
 async def add_time(edit_link: str, number: int, seconds: int) -> None:
     """Add time to the first timer on the page."""
-    await find_timer(edit_link, number).add_time(seconds)
+    timer = await find_timer(edit_link, number)
+    await timer.add_time(seconds)
 
 
 @app.post("/timer/{edit_link}/{number}/rename", status_code=204)
 async def rename_timer(edit_link: str, number: int, name: str) -> None:
     """Rename a timer by its edit link and number."""
-    await find_timer(edit_link, number).rename(name)
+    timer = await find_timer(edit_link, number)
+    await timer.rename(name)
+
+
+@app.post("/page/{edit_link}/batch", status_code=204)
+async def apply_batch(edit_link: str, batch: TimerBatch) -> None:
+    """Apply operations to the timers of a page in order, saving and broadcasting them once."""
+    page = await page_store.get_by_edit_link(edit_link)
+    if not page:
+        raise HTTPException(status_code=404, detail="Page not found")
+
+    try:
+        await page.apply_batch(
+            (operation.action, operation.timers, operation.seconds)
+            for operation in batch.operations
+        )
+    except IndexError:
+        raise HTTPException(status_code=404, detail="Timer not found")
 
 
 @app.post("/page/{edit_link}/timers", status_code=201)
 async def create_timer(edit_link: str, new_timer: NewTimer, request: Request) -> None:
     """Create a new timer on the page."""
-    page = edit_links.get(edit_link)
+    page = await page_store.get_by_edit_link(edit_link)
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
 
@@ -232,26 +429,20 @@ async def create_timer(edit_link: str, new_timer: NewTimer, request: Request) ->
 @app.put("/page/{edit_link}/settings", status_code=204)
 async def modify_page_settings(edit_link: str, settings: ModifyPageSettings) -> None:
     """Modify the settings of a timer page."""
-    page = edit_links.get(edit_link)
+    page = await page_store.get_by_edit_link(edit_link)
     if not page:
         raise HTTPException(status_code=404, detail="Page not found")
 
-    page.name = settings.name
-    page.color = settings.color
-
-    # Broadcast the updated settings to all connected websockets
-    await page.save()
+    await page.update_settings(settings.name, settings.color)
 
 
-def check_admin_auth(request: Request) -> None:
+async def check_admin_auth(request: Request) -> None:
     """Check if the request is authorized for admin access."""
     if not ADMIN_PASSWORD_HASH:
         raise HTTPException(status_code=401, detail="Not configured")
 
-    last_failed = last_failed_password_entry.get(get_remote_address(request))
-    if last_failed and (
-        last_failed + FAILED_PASSWORD_BAN > datetime.datetime.now(datetime.timezone.utc)
-    ):
+    ip = get_remote_address(request)
+    if await client_state.is_banned(f"admin:{ip}"):
         raise HTTPException(status_code=401, detail="Unauthorized")
 
     authorization = request.headers.get("Authorization")
@@ -260,41 +451,88 @@ def check_admin_auth(request: Request) -> None:
         not authorization.startswith("Plain ")
         or sha256(authorization.split(" ")[1].strip()) != ADMIN_PASSWORD_HASH
     ):
-        ip = get_remote_address(request)
-        last_failed_password_entry[ip] = datetime.datetime.now(datetime.timezone.utc)
+        await client_state.ban(f"admin:{ip}", FAILED_PASSWORD_BAN.total_seconds())
 
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
 @app.get("/admin/index")
-async def admin_index(request: Request) -> list:
-    """Get an index of all pages for admin purposes."""
-    check_admin_auth(request)
+async def admin_index(
+    request: Request,
+    origin: Annotated[list[str] | None, Query()] = None,
+    sort: SortField = "last_modified",
+    order: SortOrder = "desc",
+    limit: Annotated[int, Query(ge=1, le=5000)] = 500,
+    cursor: str | None = None,
+) -> dict:
+    """Get a page of the index of all pages for admin purposes."""
+    await check_admin_auth(request)
+
+    # Pages are loaded on demand, so the DB is the only place that has all of them
+    await page_flusher.flush()
+
+    try:
+        return await query_index(
+            collection, origins=origin or [], sort=sort, order=order, limit=limit, cursor=cursor
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 
-    index = []
+@app.get("/admin/index/stats")
+async def admin_index_stats(request: Request) -> dict:
+    """Get the number of pages and timers per origin."""
+    await check_admin_auth(request)
 
-    for page in edit_links.values():
-        index.append(page.to_full_json())
+    await page_flusher.flush()
+    return await index_stats(collection)
 
-    return index
+
+@app.get("/admin/persistence")
+async def admin_persistence(request: Request) -> dict:
+    """Get statistics about the background persistence of pages."""
+    await check_admin_auth(request)
+
+    return page_flusher.stats()
+
+
+@app.get("/admin/client_state")
+async def admin_client_state(request: Request) -> dict:
+    """Get the size of the state kept to ban and rate limit clients."""
+    await check_admin_auth(request)
+
+    return await client_state.stats()
+
+
+@app.get("/admin/metrics", response_class=PlainTextResponse)
+async def admin_metrics(request: Request) -> PlainTextResponse:
+    """Get the metrics of this replica in the Prometheus text format."""
+    await check_admin_auth(request)
+
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/admin/rum_analytics")
 async def admin_rum_analytics(request: Request, hosts: str) -> RUMAnalytics:
     """Get RUM analytics from Cloudflare."""
-    check_admin_auth(request)
+    await check_admin_auth(request)
 
     hosts = hosts.split(",")
-    return await retrieve_rum_analytics(hosts)
+    return await rum_analytics.retrieve(hosts)
 
 
 @app.websocket("/subscribe/{link}")
 async def websocket_subscribe(*, websocket: WebSocket, link: str) -> None:
     """Subscribe to updates for a specific link."""
+    retry_after = subscribe_admission.admit()
+    if retry_after is not None:
+        await shed(websocket, retry_after)
+        return
+
     # Try to resolve the public link
-    public_page = public_links.get(link)
+    public_page = await page_store.get_by_public_link(link)
     if not public_page:
-        edit_page = edit_links.get(link)
+        edit_page = await page_store.get_by_edit_link(link)
         if not edit_page:
             await websocket.close(code=1000)
             return
@@ -302,40 +540,78 @@ async def websocket_subscribe(*, websocket: WebSocket, link: str) -> None:
     else:
         page = public_page
 
-    await websocket_manager.connect(websocket, page.public_link)
+    subscriber = await websocket_manager.connect(websocket, page, page.public_link)
 
+    # Clients that were already subscribed can resume from the last version they have seen
     try:
+        last_version = int(websocket.query_params.get("version", -1))
+    except ValueError:
+        last_version = -1
+    last_revision = websocket.query_params.get("revision", "")
+
+    for update in page.updates_since(last_version, last_revision):
+        subscriber.push(update)
+
+    clock = SyncClock()
+
+    try:
+        # Updates are pushed by broadcasts and the heartbeat, we only listen for binary time sync
+        # requests, answered right away like on /time, and typed JSON requests.
         while True:
-            await websocket.send_json(page.to_json())
-            await asyncio.sleep(10)
-    except (WebSocketDisconnect, ConnectionClosed):
+            message = await websocket.receive()
+            t2 = clock.now()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            if message.get("bytes") is not None:
+                response = reply(message, t2, clock, subscriber.subprotocol)
+                if response is not None:
+                    try:
+                        await websocket.send(response)
+                    except (WebSocketDisconnect, RuntimeError):
+                        break
+                continue
+
+            with suppress(ValueError, TypeError, KeyError):
+                request = json.loads(message["text"])
+                if request["type"] == "resync":
+                    last_version = int(request["version"])
+                    last_revision = str(request.get("revision", ""))
+                    for update in page.updates_since(last_version, last_revision):
+                        subscriber.push(update)
+    finally:
         websocket_manager.disconnect(websocket, page.public_link)
-    except Exception as e:
-        websocket_manager.disconnect(websocket, page.public_link)
-        raise e from None
 
 
 @app.websocket("/time")
 async def websocket_time(websocket: WebSocket) -> None:
-    """Websocket endpoint for time synchronization using a protocol similar to NTP."""
+    """
+    Websocket endpoint for time synchronization using a protocol similar to NTP.
+
+    Messages are handled as raw ASGI messages, so the receive and transmit times are taken
+    right after the request comes off the socket and right before the reply goes to it.
+    """
+    retry_after = time_admission.admit()
+    if retry_after is not None:
+        await shed(websocket, retry_after)
+        return
+
     await websocket.accept()
-    try:
-        while True:
-            # Receive message from client (contains t1)
-            data = await websocket.receive_text()
-            msg = json.loads(data)
-            t1 = msg.get("t1")
+    clock = SyncClock()
 
-            # Server receives at t2
-            t2 = time.time() * 1000  # ms precision
+    while True:
+        message = await websocket.receive()
+        t2 = clock.now()
 
-            # Prepare response
-            t3 = time.time() * 1000
-            payload = json.dumps({"t1": t1, "t2": t2, "t3": t3})
+        if message["type"] == "websocket.disconnect":
+            return
 
-            await websocket.send_text(payload)
-    except WebSocketDisconnect:
-        pass
+        response = reply(message, t2, clock)
+        if response is not None:
+            try:
+                await websocket.send(response)
+            except (WebSocketDisconnect, RuntimeError):
+                return
 
 
 @app.get("/ready")
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import zlib
+
+import msgpack
+import orjson
+
+from backend.constants import (
+    WS_COMPRESSION_LEVEL,
+    WS_COMPRESSION_THRESHOLD,
+    WS_COMPRESSION_WINDOW_BITS,
+)
+from backend.metrics import registry
+from backend.utils import sha256
+
+# Websocket subprotocols, in order of preference. Clients that don't ask for one get JSON.
+MSGPACK_DEFLATE = "chrono.msgpack.deflate"
+MSGPACK = "chrono.msgpack"
+JSON = "chrono.json"
+SUBPROTOCOLS = (MSGPACK_DEFLATE, MSGPACK, JSON) if WS_COMPRESSION_LEVEL else (MSGPACK, JSON)
+
+# Frames of chrono.msgpack.deflate start with a byte telling if the msgpack after it is deflated
+RAW = b"\x00"
+DEFLATED = b"\x01"
+
+DEFLATE_BYTES = registry.counter(
+    "chrono_deflate_bytes_total", "Bytes of the messages compressed, before and after", ("stage",)
+)
+DEFLATE_IN = DEFLATE_BYTES.labels("in")
+DEFLATE_OUT = DEFLATE_BYTES.labels("out")
+
+
+def negotiate(requested: list[str]) -> str | None:
+    """Pick the subprotocol to use among the ones requested by a client, if any."""
+    for subprotocol in SUBPROTOCOLS:
+        if subprotocol in requested:
+            return subprotocol
+    return None
+
+
+def deflate(
+    data: bytes, level: int = WS_COMPRESSION_LEVEL, window_bits: int = WS_COMPRESSION_WINDOW_BITS
+) -> bytes:
+    """Compress data as a raw deflate stream, on its own so the result can be sent to anyone."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits)
+    return compressor.compress(data) + compressor.flush()
+
+
+def deflate_frame(
+    data: bytes,
+    threshold: int = WS_COMPRESSION_THRESHOLD,
+    level: int = WS_COMPRESSION_LEVEL,
+    window_bits: int = WS_COMPRESSION_WINDOW_BITS,
+) -> bytes:
+    """Build the chrono.msgpack.deflate frame of a msgpack payload, compressed if worth it."""
+    if len(data) < threshold:
+        return RAW + data
+
+    compressed = deflate(data, level, window_bits)
+    DEFLATE_IN.inc(len(data))
+    DEFLATE_OUT.inc(len(compressed))
+    if len(compressed) >= len(data):
+        return RAW + data
+    return DEFLATED + compressed
+
+
+class Message:
+    """
+    A message sent to websocket subscribers, encoded at most once per encoding.
+
+    The same message is usually broadcast to many subscribers, which may not all use the same
+    subprotocol, so each encoding is only done when the first subscriber needs it.
+    """
+
+    __slots__ = ("data", "_json", "_msgpack", "_deflated", "_digest")
+
+    def __init__(self, data: dict, encoded_json: str | None = None) -> None:
+        self.data = data
+        self._json = encoded_json
+        self._msgpack: bytes | None = None
+        self._deflated: bytes | None = None
+        self._digest: str | None = None
+
+    @classmethod
+    def from_json(cls, encoded_json: str) -> Message:
+        """Build a message from its JSON encoding, as sent between replicas."""
+        return cls(orjson.loads(encoded_json), encoded_json)
+
+    def json(self) -> str:
+        """Return the message encoded as JSON."""
+        if self._json is None:
+            self._json = orjson.dumps(self.data).decode()
+        return self._json
+
+    def msgpack(self) -> bytes:
+        """Return the message encoded with msgpack."""
+        if self._msgpack is None:
+            self._msgpack = msgpack.packb(self.data)
+        return self._msgpack
+
+    def deflated(self) -> bytes:
+        """Return the chrono.msgpack.deflate frame of the message, compressed once for everyone."""
+        if self._deflated is None:
+            self._deflated = deflate_frame(self.msgpack())
+        return self._deflated
+
+    def digest(self) -> str:
+        """Return a hash of the JSON encoding, the same on every replica for the same content."""
+        if self._digest is None:
+            self._digest = sha256(self.json())
+        return self._digest
+
+    def encode(self, subprotocol: str | None) -> str | bytes:
+        """Return the message encoded for a subprotocol, JSON being the default."""
+        if subprotocol == MSGPACK_DEFLATE:
+            return self.deflated()
+        if subprotocol == MSGPACK:
+            return self.msgpack()
+        return self.json()
@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import bisect
+import math
+from abc import ABC, abstractmethod
+from typing import Callable, Generic, Iterable, TypeVar
+
+# Latency buckets in seconds, from a tenth of a millisecond to ten seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 10)
+
+
+def format_value(value: float) -> str:
+    """Format a sample value in the Prometheus text format."""
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    """Format the labels of a sample in the Prometheus text format."""
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class CounterChild:
+    """The value of a counter for a set of label values."""
+
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        """Increment the counter."""
+        self.value += amount
+
+
+class GaugeChild:
+    """The value of a gauge for a set of label values, or the function giving it at scrape time."""
+
+    __slots__ = ("value", "function")
+
+    def __init__(self) -> None:
+        self.value = 0.0
+        self.function: Callable[[], float] | None = None
+
+    def set(self, value: float) -> None:
+        """Set the gauge to a value."""
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        """Increment the gauge."""
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        """Decrement the gauge."""
+        self.value -= amount
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Compute the value of the gauge when scraped, so hot paths don't have to update it."""
+        self.function = function
+
+    def get(self) -> float:
+        """Return the current value of the gauge."""
+        return self.function() if self.function else self.value
+
+
+class HistogramChild:
+    """The observations of a histogram for a set of label values."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Record an observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+Child = TypeVar("Child", CounterChild, GaugeChild, HistogramChild)
+
+
+class Metric(ABC, Generic[Child]):
+    """
+    A metric, with one child per set of label values.
+
+    Metrics without labels have a single child, and can be used as their child directly.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.children: dict[tuple[str, ...], Child] = {}
+
+        if not labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values: str) -> Child:
+        """Return the child of a set of label values, keep it around in hot paths."""
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects the labels {self.labelnames}")
+            child = self.children[values] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self) -> Child:
+        """Create the child of a new set of label values."""
+
+    @abstractmethod
+    def samples(self) -> Iterable[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """Return the samples of the metric, as (suffix, label names, label values, value)."""
+
+    def render(self) -> str:
+        """Render the metric in the Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(names, values)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric[CounterChild]):
+    """A value that only goes up."""
+
+    type = "counter"
+
+    def _new_child(self) -> CounterChild:
+        """Create a counter at zero."""
+        return CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        """Increment the counter, if it has no labels."""
+        self._default.inc(amount)
+
+    def samples(self) -> Iterable[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """Return the value of every child."""
+        for values, child in self.children.items():
+            yield "", self.labelnames, values, child.value
+
+
+class Gauge(Metric[GaugeChild]):
+    """A value that goes up and down."""
+
+    type = "gauge"
+
+    def _new_child(self) -> GaugeChild:
+        """Create a gauge at zero."""
+        return GaugeChild()
+
+    def set(self, value: float) -> None:
+        """Set the gauge, if it has no labels."""
+        self._default.set(value)
+
+    def inc(self, amount: float = 1) -> None:
+        """Increment the gauge, if it has no labels."""
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        """Decrement the gauge, if it has no labels."""
+        self._default.dec(amount)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Compute the gauge when scraped, if it has no labels."""
+        self._default.set_function(function)
+
+    def samples(self) -> Iterable[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """Return the value of every child."""
+        for values, child in self.children.items():
+            yield "", self.labelnames, values, child.get()
+
+
+class Histogram(Metric[HistogramChild]):
+    """The distribution of observed values, such as latencies, in cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self) -> HistogramChild:
+        """Create a histogram without observations."""
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        """Record an observation, if the histogram has no labels."""
+        self._default.observe(value)
+
+    def samples(self) -> Iterable[tuple[str, tuple[str, ...], tuple[str, ...], float]]:
+        """Return the cumulative buckets, sum and count of every child."""
+        bucket_names = self.labelnames + ("le",)
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), child.counts):
+                cumulative += count
+                yield "_bucket", bucket_names, values + (format_value(bound),), cumulative
+            yield "_sum", self.labelnames, values, child.sum
+            yield "_count", self.labelnames, values, child.count
+
+
+class Registry:
+    """The set of metrics exposed by the app."""
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric to the registry."""
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        """Create and register a counter."""
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        """Create and register a gauge."""
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Create and register a histogram."""
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text format."""
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+registry = Registry()
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import PyMongoError
+
+from backend.constants import PERSISTENCE_INTERVAL
+from backend.timer import PageContext, TimerPage
+from backend.utils import PrunableDict
+
+# Attempts to reload a page that missed an update, waiting for the replica that made it to flush
+RELOAD_ATTEMPTS = 5
+
+
+class PageStore:
+    """
+    Gives access to the timer pages, loading them from the DB on demand.
+
+    Loaded pages are kept in size-bounded LRU caches, except for the pinned ones.
+    """
+
+    def __init__(self, context: PageContext, db_collection: AsyncCollection, max_size: int) -> None:
+        self.context = context
+        self.db_collection = db_collection
+
+        self.edit_links: PrunableDict[str, TimerPage] = PrunableDict(max_size, "edit_links")
+        self.public_links: PrunableDict[str, TimerPage] = PrunableDict(max_size, "public_links")
+        self.reloads: dict[str, asyncio.Task] = {}
+
+    async def create_indexes(self) -> None:
+        """Create the index used to look up pages by their edit link."""
+        await self.db_collection.create_index("edit_link")
+
+    def add(self, page: TimerPage) -> None:
+        """Add a newly created page to the store."""
+        self.edit_links[page.edit_link] = page
+        self.public_links[page.public_link] = page
+
+    async def get_by_public_link(self, link: str) -> TimerPage | None:
+        """Get a page by its public link, or None if it doesn't exist."""
+        page = self.public_links.get(link)
+        if page:
+            return page
+
+        page = await self._load({"_id": link})
+        if page:
+            self.public_links[link] = page
+        return page
+
+    async def get_by_edit_link(self, link: str) -> TimerPage | None:
+        """Get a page by its edit link, or None if it doesn't exist."""
+        page = self.edit_links.get(link)
+        if page:
+            return page
+
+        page = await self._load({"edit_link": link})
+        if page:
+            self.edit_links[link] = page
+        return page
+
+    async def find_public_link(self, link: str) -> str | None:
+        """Return the public link of a page from either of its links, without loading it."""
+        page = self.public_links.get(link) or self.edit_links.get(link)
+        if page:
+            return page.public_link
+
+        document = await self.db_collection.find_one(
+            {"$or": [{"_id": link}, {"edit_link": link}]}, {"_id": 1}
+        )
+        return document["_id"] if document else None
+
+    def get_cached(self, public_link: str, edit_link: str) -> TimerPage | None:
+        """Get the loaded instance of a page from its links, without going to the DB."""
+        return self.public_links.get(public_link) or self.edit_links.get(edit_link)
+
+    def reload_later(self, page: TimerPage, version: int) -> None:
+        """
+        Reload a page that missed an update made by another replica, once it is persisted.
+
+        The loaded instance is updated in place, since its subscribers hold on to it, and they
+        are sent a snapshot.
+        """
+        if page.public_link not in self.reloads:
+            self.reloads[page.public_link] = asyncio.create_task(self._reload(page, version))
+
+    async def _reload(self, page: TimerPage, version: int) -> None:
+        """Wait for a version of a page to be persisted, then load it."""
+        try:
+            for _ in range(RELOAD_ATTEMPTS):
+                await asyncio.sleep(PERSISTENCE_INTERVAL)
+                try:
+                    document = await self.db_collection.find_one({"_id": page.public_link})
+                except PyMongoError:
+                    logging.exception("Failed to reload page %s.", page.public_link)
+                    continue
+
+                if document is None:
+                    return
+                if document.get("version", 0) >= version:
+                    # Versions are numbered again when lost, only the revision tells them apart
+                    if page.revision_at(document.get("version", 0)) != document.get("revision", ""):
+                        message = page.reset(document)
+                        self.context.websocket_manager.broadcast_update(page.public_link, message)
+                    return
+
+            logging.warning("Page %s is still missing version %d.", page.public_link, version)
+        finally:
+            del self.reloads[page.public_link]
+
+    def prune(self, max_items: int) -> bool:
+        """Remove some expired pages from the caches, return True if there are more to remove."""
+        edit_remaining = self.edit_links.prune(max_items)
+        public_remaining = self.public_links.prune(max_items)
+        return edit_remaining or public_remaining
+
+    async def _load(self, query: dict) -> TimerPage | None:
+        """Load a page from the DB, reusing the instance cached under its other link if any."""
+        document = await self.db_collection.find_one(query)
+        if document is None:
+            return None
+
+        # The page may have been loaded through its other link while we were waiting on the DB
+        page = self.get_cached(document["public_link"], document["edit_link"])
+        if page is None:
+            page = TimerPage.from_document(document, self.context)
+
+        if page.is_expired():
+            return None
+        return page
@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING
+
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import PyMongoError
+
+from backend.metrics import registry
+
+if TYPE_CHECKING:
+    from backend.timer import TimerPage
+
+# Past this many update operations in a single flush, rewriting the whole page is cheaper
+MAX_UPDATES_PER_PAGE = 4
+
+BULK_WRITE_SECONDS = registry.histogram(
+    "chrono_db_bulk_write_seconds", "Latency of the bulk writes persisting pages"
+)
+BULK_WRITE_OPERATIONS = registry.counter(
+    "chrono_db_write_operations_total", "Write operations sent to the DB to persist pages"
+)
+FAILED_FLUSHES = registry.counter("chrono_failed_flushes_total", "Flushes that failed to persist")
+WRITE_CONFLICTS = registry.counter(
+    "chrono_write_conflicts_total", "Pages reset because another replica stored them first"
+)
+
+
+def change_to_update(change: dict) -> dict | list:
+    """Translate a change broadcast to subscribers into a MongoDB update."""
+    operation = change["op"]
+
+    if operation == "timer":
+        prefix = f"timers.{change['index']}"
+        return {"$set": {f"{prefix}.{key}": value for key, value in change["fields"].items()}}
+
+    if operation == "page":
+        return {"$set": dict(change["fields"])}
+
+    if operation == "insert":
+        # Count the timers rather than incrementing, documents may not have a count yet
+        index = change["index"]
+        before = {"$slice": ["$timers", index]}
+        after = {"$slice": ["$timers", index, {"$max": [{"$size": "$timers"}, 1]}]}
+        return [
+            {
+                "$set": {
+                    "timers": {"$concatArrays": [before, {"$literal": [change["timer"]]}, after]}
+                }
+            },
+            {"$set": {"timer_count": {"$size": "$timers"}}},
+        ]
+
+    if operation == "delete":
+        # There is no operator to remove an array element by index, splice it in a pipeline
+        index = change["index"]
+        before = {"$slice": ["$timers", index]}
+        after = {"$slice": ["$timers", index + 1, {"$size": "$timers"}]}
+        return [
+            {"$set": {"timers": {"$concatArrays": [before, after]}}},
+            {"$set": {"timer_count": {"$size": "$timers"}}},
+        ]
+
+    raise ValueError(f"Unknown change operation {change['op']!r}")
+
+
+class PendingWrite:
+    """
+    The updates waiting to be written for a single page.
+
+    The updates only apply on top of the revision of the page they were made from, so a replica
+    never writes its changes over different ones stored by another replica. Without a base, the
+    page is written whatever the DB holds, which is how new pages are inserted.
+    """
+
+    def __init__(
+        self, page: TimerPage, base_version: int = 0, expected: tuple[str, ...] | None = None
+    ) -> None:
+        self.page = page
+        self.full = False
+        self.updates: list[dict | list] = []
+
+        # The version the updates were made from, and the revisions the DB may hold for it
+        self.base_version = base_version
+        self.expected = expected
+        # The version and revision stored once the write is done
+        self.version = page.version
+        self.revision = page.revision
+
+    def add(self, changes: tuple[dict, ...]) -> None:
+        """Add changes to the pending write, merging them with the previous ones when possible."""
+        self.version = self.page.version
+        self.revision = self.page.revision
+
+        if self.full:
+            return
+
+        if not changes:
+            self.full = True
+            self.updates.clear()
+            return
+
+        for change in changes:
+            update = change_to_update(change)
+
+            last = self.updates[-1] if self.updates else None
+            # Only plain $set updates are merged, pipelines are lists of stages
+            if isinstance(last, dict) and isinstance(update, dict):
+                last["$set"].update(update["$set"])
+            else:
+                self.updates.append(update)
+
+        if len(self.updates) > MAX_UPDATES_PER_PAGE:
+            self.full = True
+            self.updates.clear()
+
+    def own_revisions(self) -> tuple[str, ...]:
+        """Return the revisions the DB goes through during this write, the last one included."""
+        if self.full:
+            return (self.revision,)
+        return (*(f"{self.revision}.{i}" for i in range(1, len(self.updates))), self.revision)
+
+    def operations(self) -> list[ReplaceOne | UpdateOne]:
+        """Return the operations to run in order to persist the page."""
+        page = self.page
+
+        if self.full:
+            # The whole page holds the changes of other replicas applied since, if any
+            self.version = page.version
+            self.revision = page.revision
+            data = page.to_full_json()
+            data["_id"] = page.public_link
+            return [ReplaceOne(self._filter(self.expected), data, upsert=self.expected is None)]
+
+        # Every update but the last moves the revision to a step of its own, so the write of
+        # another replica cannot go in between them
+        revisions = self.own_revisions()
+        operations = []
+        expected = self.expected
+        for update, revision in zip(self.updates, revisions):
+            fields = {"revision": revision}
+            if revision == self.revision:
+                fields["last_modified"] = page.last_modified.isoformat()
+                fields["version"] = self.version
+
+            if isinstance(update, list):
+                update.append({"$set": fields})
+            else:
+                update["$set"].update(fields)
+
+            operations.append(UpdateOne(self._filter(expected), update))
+            expected = (revision,)
+
+        return operations
+
+    def _filter(self, expected: tuple[str, ...] | None) -> dict:
+        """Return the filter matching the page if the DB holds one of the expected revisions."""
+        if expected is None:
+            return {"_id": self.page.public_link}
+
+        # Pages stored before revisions existed have none, which matches None
+        revisions = [revision or None for revision in expected]
+        if len(revisions) == 1:
+            return {"_id": self.page.public_link, "revision": revisions[0]}
+        return {"_id": self.page.public_link, "revision": {"$in": revisions}}
+
+
+class PageFlusher:
+    """Persists modified pages in the background, coalescing the writes made in between flushes."""
+
+    def __init__(self, db_collection: AsyncCollection) -> None:
+        self.db_collection = db_collection
+
+        self.dirty: dict[str, PendingWrite] = {}
+        self.dirty_since: float | None = None
+        self.flushing: dict[str, PendingWrite] = {}
+        # Flushes also run on demand, they must not overlap so updates of a page stay in order
+        self.lock = asyncio.Lock()
+
+        self.coalesced_writes = 0
+        self.flushed_writes = 0
+
+    @property
+    def lag(self) -> float:
+        """How long in seconds the oldest pending change has been waiting to be persisted."""
+        if self.dirty_since is None:
+            return 0.0
+        return time.monotonic() - self.dirty_since
+
+    def is_pending(self, public_link: str) -> bool:
+        """Check if a page has changes that are not yet persisted."""
+        return public_link in self.dirty or public_link in self.flushing
+
+    def mark_dirty(
+        self, page: TimerPage, changes: tuple[dict, ...] = (), base: tuple[int, str] | None = None
+    ) -> None:
+        """
+        Schedule a page to be written on the next flush.
+
+        Only the described changes are written, or the whole page if there are none. They are
+        only written on top of the base version and revision they were made from, if given.
+        """
+        pending = self.dirty.get(page.public_link)
+        if pending is None:
+            # Version 0 is the page before its first save, it isn't in the DB yet
+            if base is None or base[0] == 0:
+                pending = PendingWrite(page)
+            else:
+                pending = PendingWrite(page, base[0], (base[1],))
+            self.dirty[page.public_link] = pending
+        else:
+            self.coalesced_writes += 1
+
+        pending.add(changes)
+
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+
+    async def flush(self) -> None:
+        """
+        Write all the pending pages to the DB in as few bulk operations as possible.
+
+        A flush called while another one is running waits for it, then writes what is left.
+        """
+        async with self.lock:
+            await self._flush()
+
+    async def persist(self, page: TimerPage) -> None:
+        """Write a new page to the DB right away, along with its pending changes."""
+        async with self.lock:
+            # The page isn't in the DB yet, so it is written whole whatever its pending write
+            self.dirty.pop(page.public_link, None)
+            write = PendingWrite(page)
+            write.add(())
+            if not self.dirty:
+                self.dirty_since = None
+
+            operations = write.operations()
+            try:
+                await self.db_collection.bulk_write(operations, ordered=True)
+                BULK_WRITE_OPERATIONS.inc(len(operations))
+            except PyMongoError:
+                FAILED_FLUSHES.inc()
+                logging.exception(
+                    "Failed to persist page %s, retrying on next flush.", page.public_link
+                )
+                self.mark_dirty(page)
+
+    async def _flush(self) -> None:
+        """Write all the pending pages, with the lock held."""
+        if not self.dirty:
+            return
+
+        pending, self.dirty = self.dirty, {}
+        dirty_since, self.dirty_since = self.dirty_since, None
+        self.flushing.update(pending)
+
+        # Updates of a single page must run in order, so the n-th update of every page
+        # is sent in the n-th unordered bulk write.
+        rounds: list[list[ReplaceOne | UpdateOne]] = []
+        for write in pending.values():
+            for i, operation in enumerate(write.operations()):
+                if i == len(rounds):
+                    rounds.append([])
+                rounds[i].append(operation)
+
+        try:
+            mismatched = False
+            for operations in rounds:
+                start = time.perf_counter()
+                result = await self.db_collection.bulk_write(operations, ordered=False)
+                BULK_WRITE_SECONDS.observe(time.perf_counter() - start)
+                BULK_WRITE_OPERATIONS.inc(len(operations))
+                mismatched |= result.matched_count + result.upserted_count < len(operations)
+
+            # Some pages weren't stored in the revision their write expected
+            if mismatched:
+                await self._resolve_mismatches(pending)
+        except PyMongoError:
+            FAILED_FLUSHES.inc()
+            logging.exception("Failed to persist %d pages, retrying on next flush.", len(pending))
+
+            # We don't know which updates went through, so rewrite the pages entirely on top of
+            # any of the revisions they may have reached
+            for write in pending.values():
+                expected = None
+                if write.expected is not None:
+                    expected = (*write.expected, *write.own_revisions())
+                self._rewrite(write.page, write.base_version, expected)
+            self.dirty_since = dirty_since
+        else:
+            self.flushed_writes += sum(len(operations) for operations in rounds)
+        finally:
+            for public_link in pending:
+                self.flushing.pop(public_link, None)
+
+    async def _resolve_mismatches(self, pending: dict[str, PendingWrite]) -> None:
+        """
+        Find the writes that didn't apply, and write their pages again or reset them.
+
+        A write doesn't apply when the DB doesn't hold the revision it was made from. If the DB
+        holds an earlier version of the history of the page, the page is written again in full
+        on top of it. If it holds another history, written by a replica that changed the page
+        at the same time, the DB wins and the page is reset to it.
+        """
+        documents = {
+            document["_id"]: document
+            async for document in self.db_collection.find({"_id": {"$in": list(pending)}})
+        }
+
+        for public_link, write in pending.items():
+            document = documents.get(public_link)
+            if document is not None and document.get("revision") == write.revision:
+                continue  # Written
+
+            page = write.page
+            if document is None:
+                # The page is gone from the DB, insert it again
+                self._rewrite(page)
+                continue
+
+            version = document.get("version", 0)
+            revision = document.get("revision", "")
+            known = page.revision_at(version)
+            if known == revision or revision in write.own_revisions():
+                if version < write.version or known != revision:
+                    self._rewrite(page, version, (revision,))
+            elif known is None and version < write.base_version:
+                # The DB lags behind versions made by another replica, which we have already
+                self._rewrite(page, version, (revision,))
+            else:
+                WRITE_CONFLICTS.inc()
+                logging.warning(
+                    "Page %s was changed by another replica, resetting it.", public_link
+                )
+                self.dirty.pop(public_link, None)
+                message = page.reset(document)
+                page.context.websocket_manager.broadcast_update(public_link, message)
+
+    def _rewrite(
+        self, page: TimerPage, base_version: int = 0, expected: tuple[str, ...] | None = None
+    ) -> None:
+        """Schedule a page to be written in full, replacing its pending write."""
+        write = self.dirty[page.public_link] = PendingWrite(page, base_version, expected)
+        write.add(())
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+
+    def stats(self) -> dict:
+        """Return statistics about the persistence of pages."""
+        return {
+            "pending_pages": len(self.dirty),
+            "coalesced_writes": self.coalesced_writes,
+            "flushed_writes": self.flushed_writes,
+            "lag": self.lag,
+        }
@@ -0,0 +1,319 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import re
+from typing import Awaitable, Callable
+from urllib.parse import parse_qs
+
+import aiohttp
+from multidict import CIMultiDict
+from starlette.types import ASGIApp, Receive, Scope, Send
+from yarl import URL
+
+from backend.constants import WORKER_SOCKET_DIR
+from backend.metrics import registry
+from backend.time_sync import SyncClock, reply
+from backend.utils import random_string
+
+VIRTUAL_NODES = 64  # Points of each worker on the ring, so pages are spread evenly
+LINK_CACHE_SIZE = 100_000
+
+TOKEN_HEADER = "x-chrono-shard-token"
+# Dropped when forwarding, they only make sense for a single connection
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "content-length",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# Paths of the routes about a single page, and the link they are about
+PAGE_PATH = re.compile(r"^/(?:page|timer|subscribe)/([^/]+)")
+
+FORWARDED = registry.counter(
+    "chrono_forwarded_requests_total", "Requests forwarded to the worker owning the page", ("type",)
+)
+
+LinkResolver = Callable[[str], Awaitable[str | None]]
+
+
+def hash_key(key: str) -> int:
+    """Hash a key to a position on the ring, the same in every process."""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+def worker_socket(index: int) -> str:
+    """Return the path of the Unix socket a worker listens on for forwarded requests."""
+    return os.path.join(WORKER_SOCKET_DIR, f"worker-{index}.sock")
+
+
+class HashRing:
+    """
+    A consistent hash ring, assigning keys to workers.
+
+    Adding or removing a worker only moves the keys of its neighbours on the ring.
+    """
+
+    def __init__(self, worker_count: int, virtual_nodes: int = VIRTUAL_NODES) -> None:
+        self.worker_count = worker_count
+
+        points = sorted(
+            (hash_key(f"worker-{worker}-{node}"), worker)
+            for worker in range(worker_count)
+            for node in range(virtual_nodes)
+        )
+        self.hashes = [point for point, _ in points]
+        self.workers = [worker for _, worker in points]
+
+    def owner(self, key: str) -> int:
+        """Return the worker owning a key."""
+        if self.worker_count == 1:
+            return 0
+        index = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.workers[index]
+
+    def random_key(self, worker: int, length: int = 8) -> str:
+        """Generate a random key owned by a worker."""
+        while True:
+            key = random_string(length)
+            if self.owner(key) == worker:
+                return key
+
+
+def forwarded_headers(scope: Scope, token: str, excluded: set[str]) -> CIMultiDict:
+    """Return the headers of a request to forward, marked as coming from another worker."""
+    headers = CIMultiDict(
+        (name.decode("latin-1"), value.decode("latin-1"))
+        for name, value in scope["headers"]
+        if name.decode("latin-1").lower() not in excluded
+    )
+    headers[TOKEN_HEADER] = token
+
+    # The owner sees the connection of the forwarding worker, keep the address of the client
+    if "cf-connecting-ip" not in headers and scope.get("client"):
+        headers["cf-connecting-ip"] = scope["client"][0]
+    return headers
+
+
+def forwarded_url(scope: Scope, scheme: str) -> URL:
+    """Return the URL of a request on another worker, the host is ignored on Unix sockets."""
+    path = scope.get("raw_path") or scope["path"].encode()
+    query = scope.get("query_string", b"")
+    target = path + (b"?" + query if query else b"")
+    return URL(f"{scheme}://worker{target.decode('latin-1')}", encoded=True)
+
+
+class Forwarder:
+    """Forwards requests and websocket subscriptions to other workers, over their Unix sockets."""
+
+    def __init__(self, token: str) -> None:
+        self.token = token
+        self.sessions: dict[int, aiohttp.ClientSession] = {}
+
+    def session(self, worker: int) -> aiohttp.ClientSession:
+        """Return the session connected to a worker, creating it on first use."""
+        session = self.sessions.get(worker)
+        if session is None:
+            connector = aiohttp.UnixConnector(path=worker_socket(worker))
+            session = self.sessions[worker] = aiohttp.ClientSession(
+                connector=connector, auto_decompress=False
+            )
+        return session
+
+    async def close(self) -> None:
+        """Close the connections to the other workers."""
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+    async def http(self, worker: int, scope: Scope, receive: Receive, send: Send) -> None:
+        """Forward an HTTP request to a worker, and send its response back."""
+        FORWARDED.labels("http").inc()
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        try:
+            async with self.session(worker).request(
+                scope["method"],
+                forwarded_url(scope, "http"),
+                headers=forwarded_headers(scope, self.token, HOP_BY_HOP_HEADERS),
+                data=bytes(body),
+                allow_redirects=False,
+            ) as response:
+                content = await response.read()
+                headers = [
+                    (name, value)
+                    for name, value in response.raw_headers
+                    if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS
+                ]
+                headers.append((b"content-length", str(len(content)).encode()))
+        except aiohttp.ClientError:
+            logging.exception("Failed to forward a request to worker %d.", worker)
+            await send({"type": "http.response.start", "status": 502, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        await send({"type": "http.response.start", "status": response.status, "headers": headers})
+        await send({"type": "http.response.body", "body": content})
+
+    async def websocket(self, worker: int, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Relay a websocket to a worker, until either side closes it.
+
+        Time sync requests are answered here rather than relayed, so the extra hop doesn't
+        add to their round trip.
+        """
+        FORWARDED.labels("websocket").inc()
+        await receive()  # websocket.connect
+
+        excluded = HOP_BY_HOP_HEADERS | {
+            "sec-websocket-key",
+            "sec-websocket-version",
+            "sec-websocket-extensions",
+            "sec-websocket-protocol",
+        }
+        try:
+            upstream = await self.session(worker).ws_connect(
+                forwarded_url(scope, "ws"),
+                protocols=scope.get("subprotocols", ()),
+                headers=forwarded_headers(scope, self.token, excluded),
+            )
+        except aiohttp.ClientError:
+            # The owner refused the subscription, most likely because the page doesn't exist
+            await send({"type": "websocket.close", "code": 1000})
+            return
+
+        await send({"type": "websocket.accept", "subprotocol": upstream.protocol})
+        clock = SyncClock()
+
+        async def to_client() -> None:
+            while True:
+                message = await upstream.receive()
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    await send({"type": "websocket.send", "text": message.data})
+                elif message.type == aiohttp.WSMsgType.BINARY:
+                    await send({"type": "websocket.send", "bytes": message.data})
+                else:
+                    break
+
+            # Keep the reason, it tells shed clients when to try again
+            reason = message.extra if message.type == aiohttp.WSMsgType.CLOSE else None
+            await send(
+                {
+                    "type": "websocket.close",
+                    "code": upstream.close_code or 1000,
+                    "reason": reason or "",
+                }
+            )
+
+        async def to_owner() -> None:
+            while True:
+                message = await receive()
+                t2 = clock.now()
+                if message["type"] == "websocket.disconnect":
+                    return
+
+                if message.get("bytes") is not None:
+                    response = reply(message, t2, clock, upstream.protocol)
+                    if response is not None:
+                        await send(response)
+                elif message.get("text") is not None:
+                    await upstream.send_str(message["text"])
+
+        tasks = [asyncio.create_task(to_client()), asyncio.create_task(to_owner())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await upstream.close()
+
+
+class ShardRouter:
+    """
+    ASGI middleware sending the requests about a page to the worker owning it.
+
+    Pages are owned by the worker their public link hashes to, so each page is only ever loaded
+    and modified by a single worker. Edit links are resolved to public links, and kept in a
+    bounded cache since they never change. Admin requests can target a worker with `?worker=`.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        *,
+        ring: HashRing,
+        worker: int,
+        forwarder: Forwarder,
+        resolve: LinkResolver,
+    ) -> None:
+        self.app = app
+        self.ring = ring
+        self.worker = worker
+        self.forwarder = forwarder
+        self.resolve = resolve
+        self.public_links: dict[str, str] = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """Handle a request here if this worker owns it, or forward it to its owner."""
+        if scope["type"] in ("http", "websocket"):
+            owner = await self.owner(scope)
+            if owner != self.worker:
+                if scope["type"] == "http":
+                    await self.forwarder.http(owner, scope, receive, send)
+                else:
+                    await self.forwarder.websocket(owner, scope, receive, send)
+                return
+
+        await self.app(scope, receive, send)
+
+    async def owner(self, scope: Scope) -> int:
+        """Return the worker that must handle a request."""
+        for name, value in scope["headers"]:
+            if name == TOKEN_HEADER.encode() and value.decode("latin-1") == self.forwarder.token:
+                return self.worker  # Already forwarded by another worker
+
+        path = scope["path"]
+        if path.startswith("/admin/"):
+            query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+            try:
+                worker = int(query["worker"][0])
+            except (KeyError, ValueError):
+                return self.worker
+            return worker if 0 <= worker < self.ring.worker_count else self.worker
+
+        match = PAGE_PATH.match(path)
+        if match is None or path == "/page/new":
+            return self.worker
+
+        return self.ring.owner(await self.public_link(match.group(1)))
+
+    async def public_link(self, link: str) -> str:
+        """Return the public link of the page a link is about."""
+        public_link = self.public_links.get(link)
+        if public_link is not None:
+            return public_link
+
+        public_link = await self.resolve(link)
+        if public_link is None:
+            # Pages are only written to the DB a moment after being created, but their edit
+            # links are owned by the same worker as their public links, so they hash right.
+            return link
+
+        if len(self.public_links) >= LINK_CACHE_SIZE:
+            del self.public_links[next(iter(self.public_links))]
+        self.public_links[link] = public_link
+        return public_link
@@ -0,0 +1,61 @@
+import json
+import struct
+import time
+
+import msgpack
+
+from backend.messages import MSGPACK, MSGPACK_DEFLATE, RAW
+
+# Binary time sync frames, all timestamps are little-endian float64 milliseconds since the epoch.
+# Requests carry the client transmit time t1, replies echo it with the server times t2 and t3.
+REQUEST = struct.Struct("<d")
+REPLY = struct.Struct("<ddd")
+
+
+class SyncClock:
+    """
+    A high-resolution wall clock, for the receive and transmit times of time sync samples.
+
+    It reads the performance counter, anchored to the wall clock when created, so consecutive
+    readings measure the time spent in between precisely, even if the system clock is adjusted.
+    """
+
+    __slots__ = ("anchor",)
+
+    def __init__(self) -> None:
+        self.anchor = time.time_ns() - time.perf_counter_ns()
+
+    def now(self) -> float:
+        """Return the current time in milliseconds since the epoch."""
+        return (time.perf_counter_ns() + self.anchor) / 1_000_000
+
+
+def reply(
+    message: dict, t2: float, clock: SyncClock, subprotocol: str | None = None
+) -> dict | None:
+    """
+    Build the reply to a time sync request received at t2, as an ASGI websocket send message.
+
+    Binary requests get binary replies, JSON ones the original JSON reply. Return None for
+    requests that aren't understood.
+
+    With the msgpack subprotocols, page messages are binary too, so replies are sent as a msgpack
+    array [t1, t2, t3] that clients can tell apart from the page messages, which are maps.
+    """
+    data = message.get("bytes")
+    if data is not None:
+        if len(data) != REQUEST.size:
+            return None
+        (t1,) = REQUEST.unpack(data)
+        if subprotocol == MSGPACK:
+            return {"type": "websocket.send", "bytes": msgpack.packb([t1, t2, clock.now()])}
+        if subprotocol == MSGPACK_DEFLATE:
+            data = RAW + msgpack.packb([t1, t2, clock.now()])
+            return {"type": "websocket.send", "bytes": data}
+        return {"type": "websocket.send", "bytes": REPLY.pack(t1, t2, clock.now())}
+
+    try:
+        t1 = json.loads(message["text"]).get("t1")
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+    return {"type": "websocket.send", "text": json.dumps({"t1": t1, "t2": t2, "t3": clock.now()})}
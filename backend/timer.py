@@ -1,22 +1,66 @@
 from __future__ import annotations
 
+import os
 import time
+from collections import deque
+from dataclasses import dataclass
 from datetime import datetime
-
-from pymongo.asynchronous.collection import AsyncCollection
+from itertools import islice
+from typing import Iterable, Literal
 
 from backend.constants import EXPIRATION
-from backend.utils import Expirable, random_string
+from backend.deadlines import DeadlineScheduler
+from backend.messages import Message
+from backend.metrics import registry
+from backend.persistence import PageFlusher
+from backend.update_bus import PageUpdate, UpdateBus
+from backend.utils import Cacheable, random_string
 from backend.websocket_manager import WebsocketManager
 
+PATCH_HISTORY_SIZE = 32
+
+# The actions that can be applied to many timers at once, see TimerPage.apply_batch
+TimerAction = Literal["start", "pause", "reset", "add_time"]
+
+SAVE_SECONDS = registry.histogram(
+    "chrono_page_save_seconds", "Time taken to save and broadcast a page change", ("kind",)
+)
+PATCH_SAVE_SECONDS = SAVE_SECONDS.labels("patch")
+SNAPSHOT_SAVE_SECONDS = SAVE_SECONDS.labels("snapshot")
+
+
+@dataclass(slots=True)
+class PageContext:
+    """The dependencies shared by every page, held once rather than by each page."""
 
-class TimerPage(Expirable):
+    websocket_manager: WebsocketManager
+    flusher: PageFlusher
+    update_bus: UpdateBus
+    deadlines: DeadlineScheduler
+
+
+class TimerPage(Cacheable):
     """Represents a page that contains multiple timers and manages their state."""
 
+    # We keep a lot of pages in memory, slots spare each of them a __dict__
+    __slots__ = (
+        "timers",
+        "public_link",
+        "edit_link",
+        "name",
+        "color",
+        "last_modified",
+        "origin",
+        "version",
+        "revision",
+        "context",
+        "_snapshot",
+        "_patches",
+    )
+
     def __init__(
         self,
-        websocket_manager: WebsocketManager,
-        db_collection: AsyncCollection,
+        context: PageContext,
         *,
         timers: list[Timer] = None,
         public_link: str = None,
@@ -25,6 +69,8 @@ class TimerPage(Expirable):
         color: str = "indigo",
         last_modified: datetime = None,
         origin: str = "unknown://",
+        version: int = 0,
+        revision: str = "",
     ) -> None:
         self.timers = timers or []
         self.public_link = public_link or random_string(8)
@@ -35,36 +81,207 @@ class TimerPage(Expirable):
         self.last_modified = last_modified or datetime.now()
         self.origin = origin
 
-        self.websocket_manager = websocket_manager
-        self.db_collection = db_collection
+        # Bumped on every mutation, used to cache the snapshot message and resume subscribers.
+        # Versions lost before a flush are numbered again, the random revision of each version
+        # tells them apart.
+        self.version = version
+        self.revision = revision
+        self._snapshot: tuple[int, Message] | None = None
+        # Only created once the page is modified, most loaded pages are only read. Patches are
+        # kept with the revision they apply on top of.
+        self._patches: deque[tuple[int, str, Message]] | None = None
+
+        self.context = context
+
+    @classmethod
+    def from_document(cls, document: dict, context: PageContext) -> TimerPage:
+        """Build a page from its DB document."""
+        page = cls(
+            context,
+            public_link=document["public_link"],
+            edit_link=document["edit_link"],
+            origin=document.get("origin", "unknown://"),
+        )
+        page.load_document(document)
+        return page
+
+    def load_document(self, document: dict) -> None:
+        """Replace the state of the page with the one of a DB document."""
+        self.name = document["name"]
+        self.color = document["color"]
+        self.last_modified = datetime.fromisoformat(document["last_modified"])
+        self.version = document.get("version", 0)
+        self.revision = document.get("revision", "")
+        self._snapshot = None  # It may be of another revision with the same version
+
+        deadlines = self.context.deadlines
+        # Deadlines still waiting to fire here, the other past ones already fired
+        unfired = {timer.deadline() for timer in self.timers if timer in deadlines}
+        for timer in self.timers:
+            deadlines.remove(timer)
+
+        self.timers = [Timer.from_json(timer, self) for timer in document["timers"]]
+
+        now = time.time()
+        for timer in self.timers:
+            deadline = timer.deadline()
+            if deadline is not None and (deadline > now or deadline in unfired):
+                deadlines.update(timer)
+
+    def reset(self, document: dict) -> Message:
+        """Replace the state of the page with a document, and return the snapshot to broadcast."""
+        self.load_document(document)
+        self._patches = None  # Subscribers cannot resume from before a snapshot
+        return self.snapshot()
+
+    def apply_remote_update(self, update: PageUpdate) -> Message | None:
+        """
+        Apply an update made by another replica, and return the message to broadcast locally.
+
+        Patches only carry changes, so they can only be applied on top of the revision they were
+        made from. Return None if we missed an update, the page then has to be reloaded from the DB.
+        """
+        if update.document is not None:
+            return self.reset(update.document)
+
+        if (
+            update.version != self.version + 1
+            or update.base_revision != self.revision
+            or not self._apply_changes(update.message)
+        ):
+            return None
+
+        base_revision = self.revision
+        self.version = update.version
+        self.revision = update.message.data["revision"]
+        self.last_modified = datetime.now()
+        self._add_patch(base_revision, update.message)
+        return update.message
+
+    def _apply_changes(self, patch: Message) -> bool:
+        """Apply the changes of a patch, return False if they don't fit the state of the page."""
+        deadlines = self.context.deadlines
+        now = time.time()
+
+        for change in patch.data["changes"]:
+            operation = change["op"]
+            index = change.get("index", 0)
+
+            if operation == "page":
+                self.name = change["fields"].get("name", self.name)
+                self.color = change["fields"].get("color", self.color)
+            elif operation == "insert" and 0 <= index <= len(self.timers):
+                timer = Timer.from_json(change["timer"], self)
+                self.timers.insert(index, timer)
+                deadlines.update(timer)
+            elif operation == "delete" and 0 <= index < len(self.timers):
+                deadlines.remove(self.timers.pop(index))
+            elif operation == "timer" and 0 <= index < len(self.timers):
+                timer = self.timers[index]
+                for field, value in change["fields"].items():
+                    setattr(timer, field, value)
+
+                # Like when loading a document, a deadline that passed already fired
+                deadline = timer.deadline()
+                if deadline is not None and deadline <= now:
+                    deadlines.remove(timer)
+                else:
+                    deadlines.update(timer)
+            else:
+                return False
+
+        return True
 
     async def create_timer(self, duration: float, name: str = "Chronometer") -> None:
         """Create a new timer with the specified duration."""
-        timer = Timer(duration, self, self.websocket_manager, name=name)
+        timer = Timer(duration, self, name=name)
         self.timers.append(timer)
-        await self.save()
+        await self.save({"op": "insert", "index": len(self.timers) - 1, "timer": timer.to_json()})
 
     async def delete_timer(self, index: int) -> None:
         """Delete a timer at the specified index."""
         if index < 0 or index >= len(self.timers):
             raise IndexError("Timer index out of range")
 
-        del self.timers[index]
-        await self.save()
+        self.context.deadlines.remove(self.timers.pop(index))
+        await self.save({"op": "delete", "index": index})
+
+    async def apply_batch(
+        self, operations: Iterable[tuple[TimerAction, list[int] | None, float]]
+    ) -> None:
+        """
+        Apply actions to timers in order, then save them all at once.
 
-    async def save(self) -> None:
-        """Commit the page to the DB and broadcast updates."""
+        Each operation is an action, the indexes of the timers it applies to, or None for all of
+        them, and the seconds to add if it adds time. Raise IndexError without applying anything
+        if a timer doesn't exist.
+        """
+        operations = list(operations)
+        for _, indexes, _ in operations:
+            if indexes is not None and any(not 0 <= i < len(self.timers) for i in indexes):
+                raise IndexError("Timer not found")
+
+        # Timers started or paused together share the same instant, so they stay in sync
+        now = time.time()
+        changes = []
+        for action, indexes, seconds in operations:
+            timers = self.timers if indexes is None else [self.timers[i] for i in indexes]
+            for timer in timers:
+                change = timer.apply(action, now, seconds)
+                if change:
+                    changes.append(change)
+
+        if changes:
+            await self.save(*changes)
+
+    async def update_settings(self, name: str, color: str) -> None:
+        """Update the name and color of the page."""
+        self.name = name
+        self.color = color
+        await self.save({"op": "page", "fields": {"name": name, "color": color}})
+
+    async def save(self, *changes: dict) -> None:
+        """
+        Broadcast updates and schedule the page to be committed to the DB.
+
+        When the changes are described, only a patch is broadcast, otherwise a full snapshot is.
+        """
+        start = time.perf_counter()
         self.last_modified = datetime.now()
-        data = self.to_json()
-        await self.broadcast_update(data)
-        data = self.to_full_json()
-        data["_id"] = self.public_link
+        base_revision = self.revision
+        self.version += 1
+        self.revision = os.urandom(6).hex()  # Cheaper than random_string, on every action
 
-        await self.db_collection.replace_one({"_id": self.public_link}, data, upsert=True)
+        if changes:
+            message = Message(
+                {
+                    "type": "patch",
+                    "version": self.version,
+                    "revision": self.revision,
+                    "changes": changes,
+                }
+            )
+            self._add_patch(base_revision, message)
+        else:
+            message = self.snapshot()
+            self._patches = None  # Subscribers cannot resume from before a snapshot
 
-    async def broadcast_update(self, data: dict) -> None:
-        """Broadcast the current state of the timer to all connected websockets."""
-        await self.websocket_manager.broadcast_update(self.public_link, data)
+        await self.broadcast_update(message, is_patch=bool(changes), base_revision=base_revision)
+        self.context.flusher.mark_dirty(self, changes, (self.version - 1, base_revision))
+
+        (PATCH_SAVE_SECONDS if changes else SNAPSHOT_SAVE_SECONDS).observe(
+            time.perf_counter() - start
+        )
+
+    def _add_patch(self, base_revision: str, message: Message) -> None:
+        """Keep the patch bringing subscribers to the current version, from a revision."""
+        if self._patches is None:
+            self._patches = deque(maxlen=PATCH_HISTORY_SIZE)
+        self._patches.append((self.version, base_revision, message))
+
+    async def broadcast_update(self, message: Message, is_patch: bool, base_revision: str) -> None:
+        """Broadcast an update to all connected websockets, on every replica."""
+        await self.context.update_bus.publish(self, message, is_patch, base_revision)
 
     def to_json(self) -> dict:
         """Convert the timer page to a JSON serializable dictionary."""
@@ -75,27 +292,99 @@ class TimerPage(Expirable):
             "color": self.color,
         }
 
+    def snapshot(self) -> Message:
+        """Return the snapshot message of the page, only building it once per version."""
+        if self._snapshot is None or self._snapshot[0] != self.version:
+            message = Message(
+                {
+                    "type": "snapshot",
+                    "version": self.version,
+                    "revision": self.revision,
+                    "page": self.to_json(),
+                }
+            )
+            self._snapshot = (self.version, message)
+
+        return self._snapshot[1]
+
+    def heartbeat(self) -> Message:
+        """Return the message used to let subscribers check they are up-to-date."""
+        return Message({"type": "heartbeat", "version": self.version, "revision": self.revision})
+
+    def revision_at(self, version: int) -> str | None:
+        """Return the revision the page had at a version, or None if it is too old to tell."""
+        if version == self.version:
+            return self.revision
+
+        for patch_version, base_revision, message in self._patches or ():
+            if patch_version == version + 1:
+                return base_revision
+            if patch_version == version:
+                return message.data["revision"]
+
+        return None
+
+    def updates_since(self, version: int, revision: str) -> list[Message]:
+        """Return the messages bringing a subscriber from a version to the current one."""
+        if version == self.version and revision == self.revision:
+            return []
+
+        # Patches only apply on top of the very state the subscriber has
+        for i, (patch_version, base_revision, _) in enumerate(self._patches or ()):
+            if patch_version == version + 1 and base_revision == revision:
+                return [message for _, _, message in islice(self._patches, i, None)]
+
+        return [self.snapshot()]
+
     def to_full_json(self) -> dict:
         """Convert the timer page to a full JSON serializable dictionary including private data."""
         data = self.to_json()
         data["edit_link"] = self.edit_link
         data["last_modified"] = self.last_modified.isoformat()
         data["origin"] = self.origin
+        data["version"] = self.version
+        data["revision"] = self.revision
+        data["timer_count"] = len(self.timers)
         return data
 
     def is_expired(self) -> bool:
         """Check if the page is expired based on its last modified time."""
         return (datetime.now() - self.last_modified).total_seconds() > EXPIRATION
 
+    def expiration_time(self) -> float:
+        """Return the timestamp at which the page expires if it isn't modified until then."""
+        return self.last_modified.timestamp() + EXPIRATION
+
+    def is_pinned(self) -> bool:
+        """
+        Check if the page must stay in memory.
+
+        That is the case while it has subscribers, unsaved changes or timers running to zero.
+        """
+        context = self.context
+        return (
+            self.public_link in context.websocket_manager.connections
+            or context.flusher.is_pending(self.public_link)
+            or any(timer in context.deadlines for timer in self.timers)
+        )
+
 
 class Timer:
     """Represents a single timer with start, pause, reset, and rename functionalities."""
 
+    __slots__ = (
+        "unpaused_time",
+        "remaining_duration",
+        "is_paused",
+        "full_duration",
+        "name",
+        "page",
+    )
+
     def __init__(
         self,
         duration: float,
         page: TimerPage,
-        websocket_manager: WebsocketManager,
         *,
         unpaused_time: float | None = None,
         remaining_duration: float = None,
@@ -109,42 +398,96 @@ class Timer:
         self.full_duration = full_duration or duration
         self.name = name
 
-        self.websocket_manager = websocket_manager
         self.page = page
 
+    @classmethod
+    def from_json(cls, data: dict, page: TimerPage) -> Timer:
+        """Build a timer from its JSON representation."""
+        return cls(
+            -1,  # doesn't matter as we override all the other attributes
+            page,
+            unpaused_time=data["unpaused_time"],
+            remaining_duration=data["remaining_duration"],
+            is_paused=data["is_paused"],
+            full_duration=data["full_duration"],
+            name=data["name"],
+        )
+
+    def apply(self, action: TimerAction, now: float, seconds: float = 0) -> dict | None:
+        """Apply an action at a given time without saving it, and return the change it made."""
+        change = self._apply(action, now, seconds)
+        if change:
+            self.page.context.deadlines.update(self)
+        return change
+
+    def _apply(self, action: TimerAction, now: float, seconds: float) -> dict | None:
+        """Change the state of the timer for an action."""
+        if action == "start":
+            if not self.is_paused:
+                return None
+            self.unpaused_time = now
+            self.is_paused = False
+            return self.changes("unpaused_time", "is_paused")
+
+        if action == "pause":
+            if self.is_paused:
+                return None
+            self.remaining_duration -= now - self.unpaused_time
+            self.is_paused = True
+            self.unpaused_time = None
+            return self.changes("remaining_duration", "is_paused", "unpaused_time")
+
+        if action == "reset":
+            self.remaining_duration = self.full_duration
+            self.is_paused = True
+            self.unpaused_time = None
+            return self.changes("remaining_duration", "is_paused", "unpaused_time")
+
+        if action == "add_time":
+            self.full_duration += seconds
+            self.remaining_duration += seconds
+            return self.changes("full_duration", "remaining_duration")
+
+        raise ValueError(f"Unknown timer action {action!r}")
+
     async def start(self) -> None:
         """Start the timer."""
-        if self.is_paused:
-            self.unpaused_time = time.time()
-            self.is_paused = False
-            await self.page.save()
+        change = self.apply("start", time.time())
+        if change:
+            await self.page.save(change)
 
     async def pause(self) -> None:
         """Pause the timer."""
-        if not self.is_paused:
-            elapsed_time = time.time() - self.unpaused_time
-            self.remaining_duration -= elapsed_time
-            self.is_paused = True
-            self.unpaused_time = None
-            await self.page.save()
+        change = self.apply("pause", time.time())
+        if change:
+            await self.page.save(change)
 
     async def reset(self) -> None:
         """Reset the timer to its full duration."""
-        self.remaining_duration = self.full_duration
-        self.is_paused = True
-        self.unpaused_time = None
-        await self.page.save()
+        await self.page.save(self.apply("reset", time.time()))
 
     async def add_time(self, additional_time: float) -> None:
         """Add time to the timer."""
-        self.full_duration += additional_time
-        self.remaining_duration += additional_time
-        await self.page.save()
+        await self.page.save(self.apply("add_time", time.time(), additional_time))
 
     async def rename(self, new_name: str) -> None:
         """Rename the timer."""
         self.name = new_name
-        await self.page.save()
+        await self.page.save(self.changes("name"))
+
+    def deadline(self) -> float | None:
+        """Return the time at which the timer reaches zero, or None if it isn't running to it."""
+        if self.is_paused or self.remaining_duration <= 0:
+            return None
+        return self.unpaused_time + self.remaining_duration
+
+    def changes(self, *fields: str) -> dict:
+        """Describe a change of some fields of this timer, to be sent as part of a patch."""
+        return {
+            "op": "timer",
+            "index": self.page.timers.index(self),
+            "fields": {field: getattr(self, field) for field in fields},
+        }
 
     def to_json(self) -> dict:
         """Convert the timer to a JSON serializable dictionary."""
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import suppress
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Awaitable, Callable
+
+from pymongo.asynchronous.collection import AsyncCollection
+from pymongo.errors import OperationFailure, PyMongoError
+
+from backend.messages import Message
+from backend.utils import random_string
+
+if TYPE_CHECKING:
+    from backend.timer import TimerPage
+
+# How long updates are kept in the DB for replicas to pick them up, in seconds
+MONGO_UPDATE_RETENTION = 60
+# Updates waiting to be sent to the other replicas, past that the oldest ones are dropped and
+# replicas reload the pages from the DB when they notice the missing versions
+MAX_OUTBOX_SIZE = 10_000
+PUBLISH_BATCH_SIZE = 100
+# Errors of change streams that cannot be resumed, because the change to resume from is gone
+CHANGE_STREAM_LOST_CODES = {280, 286}
+
+
+@dataclass
+class PageUpdate:
+    """
+    An update of a page, as sent between replicas.
+
+    Patches only carry their message and the revision they apply on top of, snapshots also carry
+    the document of the page.
+    """
+
+    replica: str
+    public_link: str
+    edit_link: str
+    version: int
+    message: Message
+    is_patch: bool
+    base_revision: str | None = None
+    document: dict | None = None
+
+
+UpdateHandler = Callable[[PageUpdate], Awaitable[None]]
+
+
+class UpdateBus(ABC):
+    """
+    Carries page updates to every replica of the backend, including the one they come from.
+
+    Updates are always delivered to the local replica first, then sent to the other ones.
+    """
+
+    def __init__(self) -> None:
+        self.replica_id = random_string(8)
+        self.handlers: list[UpdateHandler] = []
+
+    def subscribe(self, handler: UpdateHandler) -> None:
+        """Register a handler called with every update, local or remote."""
+        self.handlers.append(handler)
+
+    async def publish(
+        self, page: TimerPage, message: Message, is_patch: bool, base_revision: str | None = None
+    ) -> None:
+        """Publish an update of a page, with the message to send to subscribers."""
+        update = PageUpdate(
+            self.replica_id,
+            page.public_link,
+            page.edit_link,
+            page.version,
+            message,
+            is_patch,
+            base_revision,
+        )
+        if not is_patch:
+            update.document = page.to_full_json()
+
+        await self.deliver(update)
+        await self.send(update)
+
+    async def deliver(self, update: PageUpdate) -> None:
+        """Deliver an update to the handlers of this replica."""
+        for handler in self.handlers:
+            await handler(update)
+
+    @abstractmethod
+    async def send(self, update: PageUpdate) -> None:
+        """Send an update to the other replicas."""
+
+    async def start(self) -> None:  # noqa: B027 - only buses reaching other processes need it
+        """Start receiving updates from the other replicas."""
+
+    async def stop(self) -> None:  # noqa: B027 - only buses reaching other processes need it
+        """Stop receiving updates from the other replicas."""
+
+
+class InMemoryUpdateBus(UpdateBus):
+    """An update bus connecting replicas living in the same process, or no other replica at all."""
+
+    def __init__(self, peers: list[InMemoryUpdateBus] | None = None) -> None:
+        super().__init__()
+
+        # Buses sharing the same peer list behave as replicas of each other
+        self.peers = peers if peers is not None else []
+        self.peers.append(self)
+
+    async def send(self, update: PageUpdate) -> None:
+        """Send an update to the other buses sharing our peer list."""
+        for peer in self.peers:
+            if peer is not self:
+                await peer.deliver(update)
+
+
+class MongoUpdateBus(UpdateBus):
+    """
+    An update bus going through a MongoDB collection, watched with a change stream.
+
+    Updates are inserted in batches by a background task, so publishing never waits on the DB.
+    """
+
+    def __init__(self, db_collection: AsyncCollection) -> None:
+        super().__init__()
+
+        self.db_collection = db_collection
+        self.watcher: asyncio.Task | None = None
+
+        self.outbox: deque[dict] = deque(maxlen=MAX_OUTBOX_SIZE)
+        self.outbox_ready = asyncio.Event()
+        self.sender: asyncio.Task | None = None
+
+    async def send(self, update: PageUpdate) -> None:
+        """Queue the update to be inserted in the collection, for the other replicas to see."""
+        self.outbox.append(
+            {
+                "replica": update.replica,
+                "public_link": update.public_link,
+                "edit_link": update.edit_link,
+                "version": update.version,
+                "message": update.message,  # Encoded by the sender, off the request path
+                "is_patch": update.is_patch,
+                "base_revision": update.base_revision,
+                "document": update.document,
+                "created_at": datetime.datetime.now(datetime.timezone.utc),
+            }
+        )
+        self.outbox_ready.set()
+
+    async def start(self) -> None:
+        """Create the TTL index of the collection, and start watching it."""
+        await self.db_collection.create_index(
+            "created_at", expireAfterSeconds=MONGO_UPDATE_RETENTION
+        )
+        self.watcher = asyncio.create_task(self._watch())
+        self.sender = asyncio.create_task(self._send_outbox())
+
+    async def stop(self) -> None:
+        """Stop watching the collection, and sending updates."""
+        for task in (self.watcher, self.sender):
+            if task:
+                task.cancel()
+                with suppress(asyncio.CancelledError):
+                    await task
+
+    async def _send_outbox(self) -> None:
+        """Insert the queued updates in order, in batches."""
+        while True:
+            await self.outbox_ready.wait()
+            self.outbox_ready.clear()
+
+            while self.outbox:
+                batch = [
+                    self.outbox.popleft() for _ in range(min(len(self.outbox), PUBLISH_BATCH_SIZE))
+                ]
+                for document in batch:
+                    document["message"] = document["message"].json()
+
+                try:
+                    await self.db_collection.insert_many(batch, ordered=True)
+                except PyMongoError:
+                    logging.exception("Failed to send %d updates to replicas.", len(batch))
+
+    async def _watch(self) -> None:
+        """Deliver the updates inserted by other replicas, reconnecting on errors."""
+        pipeline = [
+            {
+                "$match": {
+                    "operationType": "insert",
+                    "fullDocument.replica": {"$ne": self.replica_id},
+                }
+            }
+        ]
+
+        # Resuming after the last change we saw, so no update is lost while reconnecting
+        resume_token = None
+
+        while True:
+            try:
+                async with await self.db_collection.watch(
+                    pipeline, resume_after=resume_token
+                ) as stream:
+                    async for change in stream:
+                        resume_token = change["_id"]
+                        document = change["fullDocument"]
+                        update = PageUpdate(
+                            document["replica"],
+                            document["public_link"],
+                            document.get("edit_link", ""),
+                            document["version"],
+                            Message.from_json(document["message"]),
+                            document["is_patch"],
+                            document.get("base_revision"),
+                            document.get("document"),
+                        )
+
+                        try:
+                            await self.deliver(update)
+                        except Exception:
+                            logging.exception("Failed to apply an update from another replica.")
+            except PyMongoError as e:
+                if isinstance(e, OperationFailure) and e.code in CHANGE_STREAM_LOST_CODES:
+                    # Pages that missed updates will notice the gap in their versions on their
+                    # next update, and reload from the DB.
+                    logging.warning("Cannot resume the update change stream, starting over.")
+                    resume_token = None
+                else:
+                    logging.exception("Lost the update change stream, reconnecting.")
+                await asyncio.sleep(1)
@@ -1,31 +1,83 @@
 import dataclasses
 import hashlib
+import heapq
+import itertools
 import random
 import string
+import sys
+import time
 from typing import Any, Dict, Generic, Iterable, Protocol, TypeVar
 
 from starlette.requests import Request
 
+from backend.metrics import registry
+
 K = TypeVar("K")
 
+_missing = object()
+
+# Past this many stale entries, and more than valid ones, the expiration heap is rebuilt
+MAX_STALE_ENTRIES = 10_000
+
+PRUNE_SECONDS = registry.histogram(
+    "chrono_prune_seconds", "Time taken by a slice of pruning of a dict", ("dict",)
+)
+PRUNED_ITEMS = registry.counter("chrono_pruned_items_total", "Expired items removed", ("dict",))
+EVICTED_ITEMS = registry.counter(
+    "chrono_evicted_items_total", "Items evicted to stay within the maximum size", ("dict",)
+)
+
 
 class Expirable(Protocol):
     """Protocol for objects that can expire."""
 
+    __slots__ = ()
+
     def is_expired(self) -> bool:
         """Return True if the object has expired, False otherwise."""
         ...
 
+    def expiration_time(self) -> float:
+        """Return the timestamp at which the object expires, if it isn't touched until then."""
+        ...
+
 
-V = TypeVar("V", bound=Expirable)
+class Cacheable(Expirable, Protocol):
+    """Protocol for objects that can expire, and be evicted from a cache unless pinned."""
+
+    __slots__ = ()
+
+    def is_pinned(self) -> bool:
+        """Return True if the object must not be evicted, False otherwise."""
+        ...
+
+
+V = TypeVar("V", bound=Cacheable)
 
 
 class PrunableDict(Generic[K, V]):
-    """A dictionary that prunes itself when items expire."""
+    """
+    A dictionary that prunes itself when items expire.
+
+    Items are indexed in a heap by expiration time, so that pruning only goes through the items
+    that are due. Items touched since they were scheduled are simply scheduled again.
+
+    When given a maximum size, the least recently used items that aren't pinned are evicted
+    to stay within it.
+    """
 
-    def __init__(self):
-        """Initialize an empty PrunableDict."""
+    def __init__(self, max_size: int | None = None, name: str = "unnamed"):
+        """Initialize an empty PrunableDict, named in the metrics."""
         self._data: Dict[K, V] = {}
+        self.max_size = max_size
+
+        self._prune_seconds = PRUNE_SECONDS.labels(name)
+        self._pruned_items = PRUNED_ITEMS.labels(name)
+        self._evicted_items = EVICTED_ITEMS.labels(name)
+
+        self._expiration_heap: list[tuple[float, int, K]] = []
+        self._scheduled: Dict[K, float] = {}  # Only the heap entry matching this time is valid
+        self._counter = itertools.count()  # Tie-breaker, so keys are never compared
 
     def __getitem__(self, key: K) -> V:
         """Get an item by key, raising KeyError if not found."""
@@ -33,11 +85,24 @@ class PrunableDict(Generic[K, V]):
 
     def __setitem__(self, key: K, value: V) -> None:
         """Set an item by key, replacing it if it already exists."""
+        self._data.pop(key, None)
         self._data[key] = value
 
+        if key not in self._scheduled:
+            self._schedule(key, value)
+
+        if self.max_size is not None and len(self._data) > self.max_size:
+            self._evict()
+
+        # Removed items leave their entry behind until it is due, days later for pages
+        stale = len(self._expiration_heap) - len(self._scheduled)
+        if stale > max(MAX_STALE_ENTRIES, len(self._scheduled)):
+            self._rebuild_heap()
+
     def __delitem__(self, key: K) -> None:
         """Delete an item by key."""
         del self._data[key]
+        self._scheduled.pop(key, None)
 
     def __contains__(self, key: K) -> bool:
         """Check if the key exists in the dictionary."""
@@ -48,8 +113,18 @@ class PrunableDict(Generic[K, V]):
         return len(self._data)
 
     def get(self, key: K, default: V = None) -> V:
-        """Get an item by key, returning default if not found."""
-        return self._data.get(key, default)
+        """Get an item by key, returning default if not found or expired."""
+        value = self._data.pop(key, _missing)
+        if value is _missing:
+            return default
+
+        if value.is_expired():
+            self._scheduled.pop(key, None)
+            return default
+
+        # Move the item to the end, the dict order is our recency order
+        self._data[key] = value
+        return value
 
     def items(self) -> Iterable[tuple[K, V]]:
         """Return an iterable of key-value pairs."""
@@ -59,15 +134,76 @@ class PrunableDict(Generic[K, V]):
         """Return an iterable of values."""
         return self._data.values()
 
-    def prune(self) -> None:
-        """Remove items that have expired."""
-        working_data = self._data.copy()  # Copy to avoid modifying while iterating
-
-        keys_to_remove = [key for key, value in working_data.items() if value.is_expired()]
-        for key in keys_to_remove:
-            del working_data[key]
-
-        self._data = working_data
+    def container_size(self) -> int:
+        """Return the memory in bytes taken by the dict itself, not counting keys and values."""
+        return (
+            sys.getsizeof(self._data)
+            + sys.getsizeof(self._scheduled)
+            + sys.getsizeof(self._expiration_heap)
+        )
+
+    def prune(self, max_items: int | None = None) -> bool:
+        """
+        Remove items that have expired, going through at most `max_items` due entries.
+
+        Return True if there are still due entries to go through.
+        """
+        start = time.perf_counter()
+        now = time.time()
+        heap = self._expiration_heap
+        processed = 0
+        removed = 0
+
+        try:
+            while heap and heap[0][0] <= now:
+                if max_items is not None and processed >= max_items:
+                    return True
+                processed += 1
+
+                expiration, _, key = heapq.heappop(heap)
+                if self._scheduled.get(key) != expiration:
+                    continue  # Stale entry, the item was removed or scheduled again
+
+                value = self._data[key]
+                if value.is_expired():
+                    del self[key]
+                    removed += 1
+                else:
+                    self._schedule(key, value)  # It was touched since, check it again later
+
+            return False
+        finally:
+            self._pruned_items.inc(removed)
+            self._prune_seconds.observe(time.perf_counter() - start)
+
+    def _schedule(self, key: K, value: V) -> None:
+        """Add an item to the expiration heap."""
+        expiration = value.expiration_time()
+        self._scheduled[key] = expiration
+        heapq.heappush(self._expiration_heap, (expiration, next(self._counter), key))
+
+    def _rebuild_heap(self) -> None:
+        """Rebuild the expiration heap from the valid entries only."""
+        self._expiration_heap = [
+            (expiration, next(self._counter), key) for key, expiration in self._scheduled.items()
+        ]
+        heapq.heapify(self._expiration_heap)
+
+    def _evict(self) -> None:
+        """Evict the least recently used items that aren't pinned until we are within size."""
+        for _ in range(len(self._data)):
+            if len(self._data) <= self.max_size:
+                return
+
+            key = next(iter(self._data))
+            value = self._data.pop(key)
+
+            if value.is_pinned():
+                # Pinned items are moved to the end, so we don't go through them on every eviction
+                self._data[key] = value
+            else:
+                self._scheduled.pop(key, None)
+                self._evicted_items.inc()
 
 
 def random_string(length: int) -> str:
@@ -83,6 +219,18 @@ def get_remote_address(request: Request) -> str:
     return request.client.host
 
 
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Check if an If-None-Match header matches an ETag, weak ETags being equal to strong ones."""
+    if not if_none_match:
+        return False
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
 def sha256(data: str) -> str:
     """Return the SHA-256 hash of the given data as a hexadecimal string."""
     return hashlib.sha256(data.encode("utf8")).hexdigest()
@@ -1,34 +1,237 @@
-from contextlib import suppress
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Iterable, Protocol
 
-from fastapi import WebSocket, WebSocketException
+from fastapi import WebSocket, WebSocketDisconnect, WebSocketException
 from websockets.exceptions import ConnectionClosed
 
+from backend.messages import JSON, Message, negotiate
+from backend.metrics import registry
+
+SEND_QUEUE_SIZE = 8
+
+HEARTBEAT_INTERVAL = 30  # seconds between two heartbeats of the same connection
+HEARTBEAT_SLOTS = 30
+HEARTBEAT_BATCH_SIZE = 1000
+BROADCAST_BATCH_SIZE = 1000
+
+WEBSOCKET_CONNECTIONS = registry.gauge("chrono_websocket_connections", "Subscribed websockets")
+BROADCAST_SECONDS = registry.histogram(
+    "chrono_broadcast_seconds",
+    "Time taken to queue an update for the subscribers of a page, pauses between batches included",
+)
+BROADCAST_DELIVERIES = registry.counter(
+    "chrono_broadcast_deliveries_total", "Updates queued for a subscriber by broadcasts"
+)
+LAGGING_SUBSCRIBERS = registry.counter(
+    "chrono_lagging_subscribers_total", "Send queues replaced by a snapshot because they were full"
+)
+MESSAGES_SENT = registry.counter(
+    "chrono_websocket_messages_sent_total", "Messages written to websockets", ("subprotocol",)
+)
+
+
+class Subscribable(Protocol):
+    """Protocol for the pages websockets can subscribe to."""
+
+    def snapshot(self) -> Message:
+        """Return the snapshot message of the current state."""
+        ...
+
+    def heartbeat(self) -> Message:
+        """Return the message letting subscribers check they are up-to-date."""
+        ...
+
+
+class Subscriber:
+    """A single websocket connection with its own bounded send queue."""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        manager: "WebsocketManager",
+        page: Subscribable,
+        public_link: str,
+        subprotocol: str | None = None,
+    ):
+        self.websocket = websocket
+        self.manager = manager
+        self.page = page
+        self.public_link = public_link
+        self.subprotocol = subprotocol
+        self.sent_messages = MESSAGES_SENT.labels(subprotocol or JSON)
+
+        self.queue: deque[Message] = deque()
+        self.writer: asyncio.Task | None = None
+        self.heartbeat_slot = -1
+        self.closed = False
+
+    def close(self) -> None:
+        """Stop sending anything to this subscriber."""
+        self.closed = True
+        self.queue.clear()
+
+        if self.writer and self.writer is not asyncio.current_task():
+            self.writer.cancel()
+
+    def push(self, message: Message) -> None:
+        """Queue data to be sent, replacing the backlog with a snapshot if the client is lagging."""
+        if self.closed:
+            return
+
+        if len(self.queue) >= SEND_QUEUE_SIZE:
+            # The snapshot already includes this update and everything queued before it
+            self.queue.clear()
+            message = self.page.snapshot()
+            LAGGING_SUBSCRIBERS.inc()
+        self.queue.append(message)
+
+        # The writer only lives while there is something to send, idle subscribers cost no task
+        if self.writer is None:
+            self.writer = asyncio.create_task(self._write_loop())
+
+    async def _write_loop(self) -> None:
+        """Send queued messages to the websocket until the queue is drained."""
+        try:
+            while self.queue:
+                # Messages cache their encodings, so a broadcast is encoded once per subprotocol
+                data = self.queue.popleft().encode(self.subprotocol)
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+                self.sent_messages.inc()
+        except (WebSocketException, WebSocketDisconnect, ConnectionClosed, RuntimeError):
+            # Handle disconnection gracefully
+            self.manager.disconnect(self.websocket, self.public_link)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logging.exception("Unexpected error while writing to a websocket.")
+            self.manager.disconnect(self.websocket, self.public_link)
+        finally:
+            self.writer = None
+
+
+class HeartbeatWheel:
+    """
+    A timing wheel sending a heartbeat to every subscriber periodically from a single task.
+
+    Subscribers are spread over slots, and each tick only goes through one of them.
+    """
+
+    def __init__(self, interval: float = HEARTBEAT_INTERVAL, slot_count: int = HEARTBEAT_SLOTS):
+        self.interval = interval
+        self.slots: list[dict[Subscriber, None]] = [{} for _ in range(slot_count)]
+        self.cursor = 0
+
+    @property
+    def tick_interval(self) -> float:
+        """Time in seconds between two ticks of the wheel."""
+        return self.interval / len(self.slots)
+
+    def add(self, subscriber: Subscriber) -> None:
+        """Schedule a subscriber, its first beat will be one full interval from now."""
+        subscriber.heartbeat_slot = (self.cursor - 1) % len(self.slots)
+        self.slots[subscriber.heartbeat_slot][subscriber] = None
+
+    def remove(self, subscriber: Subscriber) -> None:
+        """Unschedule a subscriber."""
+        if subscriber.heartbeat_slot >= 0:
+            self.slots[subscriber.heartbeat_slot].pop(subscriber, None)
+            subscriber.heartbeat_slot = -1
+
+    async def tick(self) -> None:
+        """Send a heartbeat to the subscribers of the current slot, then advance the wheel."""
+        slot = list(self.slots[self.cursor])
+        self.cursor = (self.cursor + 1) % len(self.slots)
+
+        for i, subscriber in enumerate(slot, start=1):
+            subscriber.push(subscriber.page.heartbeat())
+
+            if i % HEARTBEAT_BATCH_SIZE == 0:
+                await asyncio.sleep(0)  # Let other tasks run between batches
+
 
 class WebsocketManager:
     """Manages websocket connections for timer pages."""
 
     def __init__(self):
-        self.connections = {}
+        self.connections: dict[str, dict[WebSocket, Subscriber]] = {}
+        self.heartbeat = HeartbeatWheel()
+
+        # Updates waiting to be queued for subscribers, and the task doing it, for each page
+        self.pending: dict[str, deque[Message]] = {}
+        self.fan_outs: dict[str, asyncio.Task] = {}
+
+    async def connect(
+        self, websocket: WebSocket, page: Subscribable, public_link: str
+    ) -> Subscriber:
+        """Add a new websocket connection, using the best subprotocol the client supports."""
+        subprotocol = negotiate(websocket.scope.get("subprotocols", []))
+        await websocket.accept(subprotocol=subprotocol)
+
+        subscriber = Subscriber(websocket, self, page, public_link, subprotocol)
+        self.connections.setdefault(public_link, {})[websocket] = subscriber
+        self.heartbeat.add(subscriber)
+        WEBSOCKET_CONNECTIONS.inc()
 
-    async def connect(self, websocket: WebSocket, public_link: str) -> None:
-        """Add a new websocket connection."""
-        self.connections.setdefault(public_link, []).append(websocket)
-        await websocket.accept()
+        return subscriber
 
     def disconnect(self, websocket: WebSocket, public_link: str) -> None:
         """Remove a websocket connection."""
-        if public_link in self.connections:
-            with suppress(ValueError):
-                self.connections[public_link].remove(websocket)
-                if not self.connections[public_link]:
-                    del self.connections[public_link]
-
-    async def broadcast_update(self, public_link: str, data: dict) -> None:
-        """Broadcast an update to all connected websockets for a specific public link."""
-        if public_link in self.connections:
-            for websocket in self.connections[public_link]:
-                try:
-                    await websocket.send_json(data)
-                except (WebSocketException, ConnectionClosed):
-                    # Handle disconnection gracefully
-                    self.disconnect(websocket, public_link)
+        subscribers = self.connections.get(public_link)
+        if subscribers is None:
+            return
+
+        subscriber = subscribers.pop(websocket, None)
+        if subscriber:
+            self.heartbeat.remove(subscriber)
+            subscriber.close()
+            WEBSOCKET_CONNECTIONS.dec()
+
+        if not subscribers:
+            del self.connections[public_link]
+
+    def broadcast_update(self, public_link: str, message: Message) -> None:
+        """
+        Broadcast an update to all connected websockets for a public link.
+
+        The update is queued for subscribers by a background task, so the cost of a broadcast
+        doesn't depend on how many subscribers the page has. Updates of a page are queued in
+        order by a single task, which only lives while it has something to broadcast.
+        """
+        if public_link not in self.connections:
+            return
+
+        pending = self.pending.get(public_link)
+        if pending is None:
+            pending = self.pending[public_link] = deque()
+            self.fan_outs[public_link] = asyncio.create_task(self._fan_out(public_link, pending))
+        pending.append(message)
+
+    async def _fan_out(self, public_link: str, pending: deque[Message]) -> None:
+        """Queue the pending updates of a page for its subscribers, pausing between batches."""
+        try:
+            while pending:
+                message = pending.popleft()
+                start = time.perf_counter()
+
+                subscribers = list(self.connections.get(public_link, {}).values())
+                for i, subscriber in enumerate(subscribers, start=1):
+                    subscriber.push(message)
+
+                    if i % BROADCAST_BATCH_SIZE == 0:
+                        await asyncio.sleep(0)  # Let other tasks run between batches
+
+                BROADCAST_DELIVERIES.inc(len(subscribers))
+                BROADCAST_SECONDS.observe(time.perf_counter() - start)
+        finally:
+            del self.pending[public_link]
+            del self.fan_outs[public_link]
+
+    def subscriber_counts(self) -> Iterable[int]:
+        """Return the number of subscribers of every page that has some."""
+        return map(len, self.connections.values())
@@ -0,0 +1,83 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import secrets
+import signal
+import socket
+from contextlib import suppress
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+
+import uvicorn
+
+from backend.constants import WORKER_COUNT, WORKER_SOCKET_DIR, WS_PER_MESSAGE_DEFLATE
+from backend.sharding import worker_socket
+
+APP = "backend.main:app"
+
+
+def serve(index: int, public_socket: socket.socket) -> None:
+    """Run a worker, on the shared public socket and on its own Unix socket for forwarding."""
+    path = worker_socket(index)
+    with suppress(FileNotFoundError):
+        os.unlink(path)
+    forward_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    forward_socket.bind(path)
+
+    config = uvicorn.Config(APP, ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE)
+    uvicorn.Server(config).run(sockets=[public_socket, forward_socket])
+
+
+def main() -> None:
+    """Start one worker per shard, and restart the ones that exit until we are stopped."""
+    parser = argparse.ArgumentParser(description="Serve the backend with pages sharded by worker.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)-10s%(message)s")
+
+    os.makedirs(WORKER_SOCKET_DIR, exist_ok=True)
+    public_socket = uvicorn.Config(APP, host=args.host, port=args.port).bind_socket()
+
+    # Workers only honor forwarded requests carrying the token of this host
+    os.environ.setdefault("SHARD_TOKEN", secrets.token_hex(16))
+    context = multiprocessing.get_context("spawn")
+
+    def start(index: int) -> BaseProcess:
+        # Workers read their index from the environment when importing the constants
+        os.environ["WORKER_INDEX"] = str(index)
+        process = context.Process(target=serve, args=(index, public_socket), name=f"worker-{index}")
+        process.start()
+        return process
+
+    processes = {index: start(index) for index in range(WORKER_COUNT)}
+    stopping = False
+
+    def stop(signum: int, frame: object) -> None:
+        nonlocal stopping
+        stopping = True
+        for process in processes.values():
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while processes:
+        wait([process.sentinel for process in processes.values()])
+
+        for index, process in list(processes.items()):
+            if process.is_alive():
+                continue
+            if stopping:
+                del processes[index]
+            else:
+                logging.warning(
+                    "Worker %d exited with code %s, restarting it.", index, process.exitcode
+                )
+                processes[index] = start(index)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Compare ways of compressing websocket messages, in CPU time against bytes saved.
+
+A page goes through a stream of messages like its subscribers see it: a snapshot, patches for
+timer actions, heartbeats, and a snapshot again for a lagging subscriber. Each way is measured
+for the whole stream:
+- none: msgpack as it is
+- shared: the chrono.msgpack.deflate subprotocol, each message is compressed once whatever the
+  number of subscribers, the compressed frame being sent to all of them
+- per-socket: permessage-deflate as done by the websocket server, every connection compresses
+  every message with its own context, which remembers the previous messages
+
+Bytes are per subscriber and message, CPU is for a broadcast of a message to SUBSCRIBERS.
+
+Run with `python -m benchmarks.compression` from the repository root.
+"""
+
+import os
+import time
+import zlib
+from functools import partial
+from typing import Callable
+
+os.environ.setdefault("GIT_SHA", "development")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost")
+os.environ.setdefault("MONGO_DATABASE", "benchmark")
+
+from backend.deadlines import DeadlineScheduler  # noqa: E402
+from backend.messages import Message, deflate_frame  # noqa: E402
+from backend.timer import PageContext, Timer, TimerPage  # noqa: E402
+from backend.websocket_manager import WebsocketManager  # noqa: E402
+
+PAGE_SIZES = {"typical": 5, "large": 50}  # timers per page
+LEVELS = (1, 6, 9)
+WINDOW_BITS = (9, 12, 15)
+THRESHOLDS = (0, 256, 1024)
+SUBSCRIBERS = 1000
+ACTIONS = 50
+REPEAT = 5
+
+
+def make_stream(timer_count: int) -> list[bytes]:
+    """Return the msgpack encoded messages a subscriber of a page receives over a while."""
+    page = TimerPage(PageContext(WebsocketManager(), None, None, DeadlineScheduler()))
+    page.timers = [Timer(300 + i, page, name=f"Round {i}") for i in range(timer_count)]
+
+    def snapshot() -> dict:
+        return {
+            "type": "snapshot",
+            "version": page.version,
+            "revision": page.revision,
+            "page": page.to_json(),
+        }
+
+    stream = [snapshot()]
+    now = 1_760_000_000.0
+    for i in range(ACTIONS):
+        timer = page.timers[i % timer_count]
+        action = ("start", "add_time", "pause")[i % 3]
+        page.version += 1
+        page.revision = os.urandom(6).hex()
+        now += 7.3
+        change = timer.apply(action, now, 30)
+        stream.append(
+            {
+                "type": "patch",
+                "version": page.version,
+                "revision": page.revision,
+                "changes": [change],
+            }
+        )
+        stream.append({"type": "heartbeat", "version": page.version, "revision": page.revision})
+    stream.append(snapshot())
+
+    return [Message(data).msgpack() for data in stream]
+
+
+def per_socket(level: int, window_bits: int) -> Callable[[], Callable[[bytes], bytes]]:
+    """Return a factory of per-connection compressors, like permessage-deflate with takeover."""
+
+    def connection() -> Callable[[bytes], bytes]:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -window_bits)
+
+        def compress(data: bytes) -> bytes:
+            # The frame leaves out the empty block ending each sync flush
+            return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+        return compress
+
+    return connection
+
+
+def measure(stream: list[bytes], compress: Callable[[bytes], bytes]) -> tuple[float, float]:
+    """Return the bytes per message and the best CPU seconds per message of a way to compress."""
+    size = sum(len(compress(data)) for data in stream) / len(stream)
+
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for data in stream:
+            compress(data)
+        best = min(best, time.perf_counter() - start)
+    return size, best / len(stream)
+
+
+def print_row(page: str, way: str, settings: str, size: float, raw: float, seconds: float) -> None:
+    """Print a row of results, CPU time being for a broadcast to every subscriber."""
+    saved = (1 - size / raw) * 100
+    print(
+        f"{page:>8} {way:>11} {settings:>16} {size:>8.1f} {saved:>7.1f} "
+        f"{seconds * 1_000_000:>13.2f}"
+    )
+
+
+def main() -> None:
+    """Run the benchmark and print the results as a table."""
+    print(f"{SUBSCRIBERS} subscribers, {ACTIONS} actions between two snapshots")
+    print(
+        f"{'page':>8} {'way':>11} {'settings':>16} {'bytes':>8} {'saved %':>7} "
+        f"{'CPU/bcast (µs)':>13}"
+    )
+    for page_name, timer_count in PAGE_SIZES.items():
+        stream = make_stream(timer_count)
+        raw, _ = measure(stream, lambda data: data)
+        print_row(page_name, "none", "-", raw, raw, 0)
+
+        for level in LEVELS:
+            for window_bits in WINDOW_BITS:
+                for threshold in THRESHOLDS:
+                    shared = partial(
+                        deflate_frame, threshold=threshold, level=level, window_bits=window_bits
+                    )
+                    size, seconds = measure(stream, shared)
+                    settings = f"l{level} w{window_bits} t{threshold}"
+                    print_row(page_name, "shared", settings, size, raw, seconds)
+
+                # Every connection keeps its own context, measured on a single one
+                size, seconds = measure(stream, per_socket(level, window_bits)())
+                settings = f"l{level} w{window_bits}"
+                print_row(page_name, "per-socket", settings, size, raw, seconds * SUBSCRIBERS)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Measure the hot paths of the backend in isolation, without any network.
+
+- `TimerPage.save`, until the timer action returns, and until the patch is written to every
+  subscriber by the background fan-out
+- `WebsocketManager.broadcast_update` alone, for an already built message
+- `PageFlusher.flush` of many modified pages, on the in-memory MongoDB stand-in
+
+Subscribers are fake websockets that only count what they are sent. Pruning has its own
+benchmark in `benchmarks.prune`.
+
+Run with `python -m benchmarks.hot_paths` from the repository root.
+"""
+
+import asyncio
+import os
+import time
+
+os.environ.setdefault("GIT_SHA", "development")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost")
+os.environ.setdefault("MONGO_DATABASE", "benchmark")
+
+from backend.deadlines import DeadlineScheduler  # noqa: E402
+from backend.messages import Message  # noqa: E402
+from backend.persistence import PageFlusher  # noqa: E402
+from backend.timer import PageContext, Timer, TimerPage  # noqa: E402
+from backend.update_bus import InMemoryUpdateBus, PageUpdate  # noqa: E402
+from backend.websocket_manager import Subscriber, WebsocketManager  # noqa: E402
+from benchmarks.memory_collection import InMemoryCollection  # noqa: E402
+
+SUBSCRIBER_COUNTS = (0, 10, 100, 1_000, 10_000)
+DIRTY_PAGE_COUNTS = (100, 1_000, 10_000)
+ITERATIONS = 200
+
+
+class FakeWebSocket:
+    """A websocket that only counts the messages it is sent."""
+
+    def __init__(self) -> None:
+        self.sent = 0
+
+    async def send_text(self, data: str) -> None:
+        """Count a text message."""
+        self.sent += 1
+
+    async def send_bytes(self, data: bytes) -> None:
+        """Count a binary message."""
+        self.sent += 1
+
+
+def make_context() -> PageContext:
+    """Create the dependencies of pages, persisting to an in-memory collection."""
+    manager = WebsocketManager()
+    update_bus = InMemoryUpdateBus(peers=[])
+
+    # Broadcasts are delivered to our subscribers like in main.on_page_update
+    async def deliver(update: PageUpdate) -> None:
+        manager.broadcast_update(update.public_link, update.message)
+
+    update_bus.subscribe(deliver)
+    return PageContext(manager, PageFlusher(InMemoryCollection()), update_bus, DeadlineScheduler())
+
+
+def make_page(context: PageContext, subscriber_count: int) -> tuple[TimerPage, list[Subscriber]]:
+    """Create a page with a few timers and some subscribers."""
+    page = TimerPage(context)
+    page.timers = [Timer(300 + i, page, name=f"Round {i}") for i in range(5)]
+
+    manager = context.websocket_manager
+    subscribers = []
+    for _ in range(subscriber_count):
+        websocket = FakeWebSocket()
+        subscriber = Subscriber(websocket, manager, page, page.public_link)
+        manager.connections.setdefault(page.public_link, {})[websocket] = subscriber
+        subscribers.append(subscriber)
+
+    return page, subscribers
+
+
+async def drain(manager: WebsocketManager, subscribers: list[Subscriber]) -> None:
+    """Wait until every broadcast is queued, and every subscriber has written its queue."""
+    while manager.fan_outs or any(subscriber.writer is not None for subscriber in subscribers):
+        await asyncio.sleep(0)
+
+
+async def measure_save(subscriber_count: int) -> tuple[float, float]:
+    """Return the time in seconds for an action to return, and to reach every subscriber."""
+    context = make_context()
+    page, subscribers = make_page(context, subscriber_count)
+
+    action = delivered = 0.0
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        await page.timers[0].add_time(1)
+        action += time.perf_counter() - start
+        await drain(context.websocket_manager, subscribers)
+        delivered += time.perf_counter() - start
+    return action / ITERATIONS, delivered / ITERATIONS
+
+
+async def measure_broadcast(subscriber_count: int) -> float:
+    """Return the time in seconds to broadcast a built message and write it to every subscriber."""
+    context = make_context()
+    page, subscribers = make_page(context, subscriber_count)
+    message = Message({"type": "patch", "version": 1, "changes": []})
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        context.websocket_manager.broadcast_update(page.public_link, message)
+        await drain(context.websocket_manager, subscribers)
+    return (time.perf_counter() - start) / ITERATIONS
+
+
+async def measure_flush(page_count: int) -> float:
+    """Return the time in seconds to flush a single change of many pages."""
+    context = make_context()
+    pages = [make_page(context, 0)[0] for _ in range(page_count)]
+    for page in pages:
+        context.flusher.mark_dirty(page)
+    await context.flusher.flush()  # Insert the pages first, only their updates are measured
+
+    for page in pages:
+        page.timers[0].name = "Renamed"
+        context.flusher.mark_dirty(page, (page.timers[0].changes("name"),))
+
+    start = time.perf_counter()
+    await context.flusher.flush()
+    return time.perf_counter() - start
+
+
+async def run() -> None:
+    """Run the benchmarks and print the results as tables."""
+    print(f"{'subscribers':>12} {'action (µs)':>12} {'delivered (µs)':>15} {'broadcast (µs)':>15}")
+    for subscriber_count in SUBSCRIBER_COUNTS:
+        action, delivered = await measure_save(subscriber_count)
+        broadcast = await measure_broadcast(subscriber_count)
+        print(
+            f"{subscriber_count:>12} {action * 1_000_000:>12.1f} {delivered * 1_000_000:>15.1f}"
+            f" {broadcast * 1_000_000:>15.1f}"
+        )
+    print()
+
+    print(f"{'dirty pages':>12} {'flush (ms)':>11}")
+    for page_count in DIRTY_PAGE_COUNTS:
+        flush = await measure_flush(page_count)
+        print(f"{page_count:>12} {flush * 1000:>11.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -0,0 +1,269 @@
+"""
+Load test the backend with synthetic websocket subscribers and timer actions.
+
+The backend runs in its own process on the in-memory MongoDB stand-in (see `benchmarks.server`),
+and this driver reports:
+- the startup time and memory of the backend against the number of stored pages
+- the memory taken by each subscriber connection
+- the latency percentiles of a broadcast, from sending an action to each subscriber receiving it
+- how many actions per second the backend takes, and how many messages it delivers per second
+
+Subscribers all run in this process, so latencies include the time this process takes to read
+the messages of every subscriber.
+
+Run with `python -m benchmarks.load` from the repository root, see `--help` for the options.
+"""
+
+import argparse
+import asyncio
+import json
+import resource
+import socket
+import statistics
+import sys
+import time
+
+import aiohttp
+from websockets.asyncio.client import ClientConnection, connect
+
+CONNECT_CONCURRENCY = 200
+ACTION_CONCURRENCY = 16
+
+
+def free_port() -> int:
+    """Return a TCP port nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def rss(pid: int) -> int:
+    """Return the resident memory of a process in bytes."""
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("Unable to read the memory of the backend")
+
+
+class Backend:
+    """A backend process, seeded with some pages."""
+
+    def __init__(self, page_count: int) -> None:
+        self.page_count = page_count
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.process: asyncio.subprocess.Process | None = None
+
+    async def start(self, session: aiohttp.ClientSession) -> float:
+        """Start the backend, and return how long it took to become ready once seeded."""
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "benchmarks.server",
+            "--pages",
+            str(self.page_count),
+            "--port",
+            str(self.port),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        if not await self.process.stdout.readline():  # Seeded, the app starts now
+            raise RuntimeError("The backend exited before starting")
+
+        start = time.perf_counter()
+        while True:
+            try:
+                async with session.get(self.url + "/ready") as response:
+                    if response.status == 200:
+                        return time.perf_counter() - start
+            except aiohttp.ClientConnectionError:
+                pass
+            await asyncio.sleep(0.01)
+
+    def memory(self) -> int:
+        """Return the resident memory of the backend in bytes."""
+        return rss(self.process.pid)
+
+    async def stop(self) -> None:
+        """Stop the backend."""
+        self.process.terminate()
+        await self.process.wait()
+
+
+class Subscribers:
+    """Websocket subscribers of a page, recording when they receive each version."""
+
+    def __init__(self) -> None:
+        self.connections: list[ClientConnection] = []
+        self.readers: list[asyncio.Task] = []
+        self.versions: list[int] = []
+
+        self.arrivals: dict[int, list[float]] = {}
+        # Version -> subscribers that haven't received it yet, and the event set once they all have
+        self.waiters: dict[int, tuple[list[int], asyncio.Event]] = {}
+
+    async def open(self, url: str, count: int) -> None:
+        """Open the connections, and wait for each of them to get the page snapshot."""
+        semaphore = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+        async def open_one() -> None:
+            async with semaphore:
+                websocket = await connect(url, max_queue=None)
+                snapshot = json.loads(await websocket.recv())
+
+            index = len(self.connections)
+            self.connections.append(websocket)
+            self.versions.append(snapshot["version"])
+            self.readers.append(asyncio.create_task(self._read(index, websocket)))
+
+        await asyncio.gather(*(open_one() for _ in range(count)))
+
+    async def _read(self, index: int, websocket: ClientConnection) -> None:
+        """Record the version of every message received by a subscriber."""
+        async for data in websocket:
+            received = time.perf_counter()
+            message = json.loads(data)
+            if message["type"] not in ("patch", "snapshot"):
+                continue
+
+            version = message["version"]
+            self.arrivals.setdefault(version, []).append(received)
+
+            previous = self.versions[index]
+            if version <= previous:
+                continue
+            self.versions[index] = version
+
+            for target, (remaining, event) in list(self.waiters.items()):
+                if previous < target <= version:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        event.set()
+                        del self.waiters[target]
+
+    async def wait_for(self, version: int, timeout: float = 30) -> None:
+        """Wait until every subscriber has received a version."""
+        remaining = sum(seen < version for seen in self.versions)
+        if remaining == 0:
+            return
+        event = asyncio.Event()
+        self.waiters[version] = ([remaining], event)
+        await asyncio.wait_for(event.wait(), timeout)
+
+    async def close(self) -> None:
+        """Close every connection."""
+        for reader in self.readers:
+            reader.cancel()
+        await asyncio.gather(
+            *(websocket.close() for websocket in self.connections), return_exceptions=True
+        )
+
+
+def percentile(samples: list[float], percent: int) -> float:
+    """Return a percentile of some samples."""
+    return statistics.quantiles(samples, n=100, method="inclusive")[percent - 1]
+
+
+async def measure_startup(session: aiohttp.ClientSession, page_counts: list[int]) -> None:
+    """Print the startup time and memory of the backend against the number of stored pages."""
+    print(f"{'pages':>9} {'startup (s)':>12} {'memory (MB)':>12}")
+    for page_count in page_counts:
+        backend = Backend(page_count)
+        startup = await backend.start(session)
+        print(f"{page_count:>9} {startup:>12.3f} {backend.memory() / 1_000_000:>12.1f}")
+        await backend.stop()
+
+
+async def measure_load(
+    session: aiohttp.ClientSession, connection_count: int, samples: int, actions: int
+) -> str:
+    """Run the load test with some subscribers, and return its row of results."""
+    backend = Backend(0)
+    await backend.start(session)
+
+    async with session.post(backend.url + "/page/new") as response:
+        edit_link = (await response.json())["edit_link"]
+    async with session.post(f"{backend.url}/page/{edit_link}/timers", json={"duration": 60}):
+        pass
+    action_url = f"{backend.url}/timer/{edit_link}/0/add_time/1"
+
+    memory_before = backend.memory()
+    subscribers = Subscribers()
+    await subscribers.open(f"ws://127.0.0.1:{backend.port}/subscribe/{edit_link}", connection_count)
+    memory_per_connection = (backend.memory() - memory_before) / connection_count
+
+    # Latency, one action at a time
+    version = max(subscribers.versions)
+    latencies = []
+    for _ in range(samples):
+        version += 1
+        start = time.perf_counter()
+        async with session.post(action_url):
+            pass
+        await subscribers.wait_for(version)
+        latencies.extend(arrival - start for arrival in subscribers.arrivals.pop(version, []))
+
+    # Throughput, many actions in flight
+    semaphore = asyncio.Semaphore(ACTION_CONCURRENCY)
+
+    async def act() -> None:
+        async with semaphore:
+            async with session.post(action_url):
+                pass
+
+    subscribers.arrivals.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(act() for _ in range(actions)))
+    acted = time.perf_counter() - start
+    await subscribers.wait_for(version + actions)
+    delivered = time.perf_counter() - start
+    messages = sum(len(arrivals) for arrivals in subscribers.arrivals.values())
+
+    await subscribers.close()
+    await backend.stop()
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return (
+        f"{connection_count:>11} {memory_per_connection / 1000:>10.1f} "
+        f"{percentile(latencies_ms, 50):>8.2f} {percentile(latencies_ms, 95):>8.2f} "
+        f"{percentile(latencies_ms, 99):>8.2f} {max(latencies_ms):>8.2f} "
+        f"{actions / acted:>10.0f} {messages / delivered:>12.0f}"
+    )
+
+
+async def run(args: argparse.Namespace) -> None:
+    """Run every measurement."""
+    async with aiohttp.ClientSession() as session:
+        await measure_startup(session, args.pages)
+        print()
+
+        print(
+            f"{'connections':>11} {'KB/conn':>10} {'p50 (ms)':>8} {'p95 (ms)':>8} "
+            f"{'p99 (ms)':>8} {'max (ms)':>8} {'actions/s':>10} {'messages/s':>12}"
+        )
+        for connection_count in args.connections:
+            print(await measure_load(session, connection_count, args.samples, args.actions))
+
+
+def main() -> None:
+    """Parse the options and run the load test."""
+    parser = argparse.ArgumentParser(description="Load test the backend.")
+    parser.add_argument(
+        "--pages", type=int, nargs="+", default=[0, 10_000, 100_000], help="stored pages"
+    )
+    parser.add_argument(
+        "--connections", type=int, nargs="+", default=[100, 1000], help="subscribers per run"
+    )
+    parser.add_argument("--samples", type=int, default=50, help="actions timed one at a time")
+    parser.add_argument("--actions", type=int, default=500, help="actions sent concurrently")
+    args = parser.parse_args()
+
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+An in-memory stand-in for the parts of the async pymongo API the backend uses.
+
+It supports the queries, updates and update pipelines the backend runs, which is enough to
+start the app and serve pages without a MongoDB server. `install` makes `AsyncMongoClient`
+return in-memory clients, it must be called before importing `backend.main`.
+"""
+
+import copy
+import itertools
+from typing import Any, AsyncIterator
+
+import pymongo
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.results import BulkWriteResult, UpdateResult
+
+
+def get_field(document: dict, path: str) -> Any:  # noqa: ANN401 - documents hold anything
+    """Get the value of a dotted field path, or None if it doesn't exist."""
+    value: Any = document
+    for part in path.split("."):
+        if isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else None
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+
+def set_field(document: dict, path: str, value: Any) -> None:  # noqa: ANN401
+    """Set the value of a dotted field path."""
+    *parents, last = path.split(".")
+    target: Any = document
+    for part in parents:
+        target = target[int(part)] if isinstance(target, list) else target.setdefault(part, {})
+
+    if isinstance(target, list):
+        target[int(last)] = value
+    else:
+        target[last] = value
+
+
+def compare(value: Any, operator: str, operand: Any) -> bool:  # noqa: ANN401
+    """Evaluate a query operator against a value."""
+    if operator == "$in":
+        return value in operand
+    if operator == "$ne":
+        return value != operand
+    if value is None:
+        return False
+    if operator == "$gt":
+        return value > operand
+    if operator == "$gte":
+        return value >= operand
+    if operator == "$lt":
+        return value < operand
+    if operator == "$lte":
+        return value <= operand
+    raise NotImplementedError(f"Query operator {operator} is not supported")
+
+
+def matches(document: dict, query: dict) -> bool:
+    """Check if a document matches a query."""
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(document, sub_query) for sub_query in condition):
+                return False
+        elif isinstance(condition, dict) and condition and next(iter(condition)).startswith("$"):
+            value = get_field(document, key)
+            if not all(compare(value, op, operand) for op, operand in condition.items()):
+                return False
+        elif get_field(document, key) != condition:
+            return False
+    return True
+
+
+def evaluate(document: dict, expression: Any) -> Any:  # noqa: ANN401
+    """Evaluate an aggregation expression, as used in update pipelines."""
+    if isinstance(expression, str) and expression.startswith("$"):
+        return get_field(document, expression[1:])
+
+    if isinstance(expression, dict) and len(expression) == 1:
+        operator, operands = next(iter(expression.items()))
+        if operator == "$literal":
+            return operands
+        if operator.startswith("$"):
+            if not isinstance(operands, list):
+                operands = [operands]
+            values = [evaluate(document, operand) for operand in operands]
+            if operator == "$size":
+                return len(values[0])
+            if operator == "$max":
+                return max(values)
+            if operator == "$ifNull":
+                return values[0] if values[0] is not None else values[1]
+            if operator == "$concatArrays":
+                return [item for array in values for item in array]
+            if operator == "$slice":
+                if len(values) == 2:
+                    array, count = values
+                    return array[:count] if count >= 0 else array[count:]
+                array, position, count = values
+                return array[position : position + count]
+            raise NotImplementedError(f"Expression operator {operator} is not supported")
+
+    return expression
+
+
+def apply_update(document: dict, update: dict | list) -> None:
+    """Apply an update, or an update pipeline made of $set stages, to a document."""
+    if isinstance(update, list):
+        for stage in update:
+            for path, expression in stage["$set"].items():
+                set_field(document, path, evaluate(document, expression))
+        return
+
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if operator == "$set":
+                set_field(document, path, copy.deepcopy(value))
+            elif operator == "$inc":
+                set_field(document, path, (get_field(document, path) or 0) + value)
+            elif operator == "$push":
+                array = get_field(document, path)
+                if array is None:
+                    array = []
+                    set_field(document, path, array)
+                if isinstance(value, dict) and "$each" in value:
+                    position = value.get("$position", len(array))
+                    array[position:position] = copy.deepcopy(value["$each"])
+                else:
+                    array.append(copy.deepcopy(value))
+            else:
+                raise NotImplementedError(f"Update operator {operator} is not supported")
+
+
+def project(document: dict, projection: dict | None) -> dict:
+    """Copy a document, leaving out the fields excluded by a projection."""
+    result = copy.deepcopy(document)
+    for key, included in (projection or {}).items():
+        if not included:
+            result.pop(key, None)
+    return result
+
+
+class InMemoryCursor:
+    """The results of a find, iterated asynchronously."""
+
+    def __init__(self, documents: list[dict]) -> None:
+        self.documents = documents
+
+    async def __aiter__(self) -> AsyncIterator[dict]:
+        """Iterate over the documents."""
+        for document in self.documents:
+            yield document
+
+
+class InMemoryCollection:
+    """A collection holding its documents in a dict, by _id."""
+
+    def __init__(self) -> None:
+        self.documents: dict[Any, dict] = {}
+        self.ids = itertools.count()
+
+    async def create_index(self, keys: Any, **kwargs: Any) -> str:  # noqa: ANN401
+        """Indexes don't matter in memory, and expiration isn't implemented."""
+        return str(keys)
+
+    def _find(self, query: dict | None) -> list[dict]:
+        """Return the stored documents matching a query."""
+        query = query or {}
+        if set(query) == {"_id"} and not isinstance(query["_id"], dict):
+            document = self.documents.get(query["_id"])
+            return [document] if document is not None else []
+        return [document for document in self.documents.values() if matches(document, query)]
+
+    async def find_one(self, query: dict | None = None, projection: dict | None = None) -> dict:
+        """Return a copy of the first document matching a query, or None."""
+        found = self._find(query)
+        return project(found[0], projection) if found else None
+
+    def find(
+        self,
+        query: dict | None = None,
+        projection: dict | None = None,
+        *,
+        sort: list[tuple[str, int]] | None = None,
+        limit: int = 0,
+    ) -> InMemoryCursor:
+        """Return a cursor over copies of the documents matching a query."""
+        found = self._find(query)
+        for key, direction in reversed(sort or []):
+            found.sort(key=lambda document: get_field(document, key), reverse=direction < 0)
+        if limit:
+            found = found[:limit]
+        return InMemoryCursor([project(document, projection) for document in found])
+
+    async def insert_one(self, document: dict) -> None:
+        """Insert a document, giving it an _id if it has none."""
+        document = copy.deepcopy(document)
+        document.setdefault("_id", next(self.ids))
+        self.documents[document["_id"]] = document
+
+    async def replace_one(
+        self, query: dict, replacement: dict, upsert: bool = False
+    ) -> UpdateResult:
+        """Replace the first document matching a query."""
+        found = self._find(query)
+        if found:
+            _id = found[0]["_id"]
+        elif upsert:
+            _id = query.get("_id", next(self.ids))
+        else:
+            return UpdateResult({"n": 0, "nModified": 0}, True)
+        self.documents[_id] = {**copy.deepcopy(replacement), "_id": _id}
+
+        if found:
+            return UpdateResult({"n": 1, "nModified": 1}, True)
+        return UpdateResult({"n": 1, "nModified": 0, "upserted": _id}, True)
+
+    async def update_one(
+        self, query: dict, update: dict | list, upsert: bool = False
+    ) -> UpdateResult:
+        """Update the first document matching a query."""
+        found = self._find(query)
+        if found:
+            apply_update(found[0], update)
+            return UpdateResult({"n": 1, "nModified": 1}, True)
+        if not upsert:
+            return UpdateResult({"n": 0, "nModified": 0}, True)
+
+        document = {key: value for key, value in query.items() if not key.startswith("$")}
+        document.setdefault("_id", next(self.ids))
+        apply_update(document, update)
+        self.documents[document["_id"]] = document
+        return UpdateResult({"n": 1, "nModified": 0, "upserted": document["_id"]}, True)
+
+    async def update_many(self, query: dict, update: dict | list) -> None:
+        """Update every document matching a query."""
+        for document in self._find(query):
+            apply_update(document, update)
+
+    async def bulk_write(self, requests: list, ordered: bool = True) -> BulkWriteResult:
+        """Run replace and update operations, in order."""
+        counts = {"nMatched": 0, "nModified": 0, "nUpserted": 0, "nInserted": 0, "nRemoved": 0}
+        upserted = []
+        for index, request in enumerate(requests):
+            if isinstance(request, ReplaceOne):
+                result = await self.replace_one(request._filter, request._doc, request._upsert)
+            elif isinstance(request, UpdateOne):
+                result = await self.update_one(request._filter, request._doc, bool(request._upsert))
+            else:
+                raise NotImplementedError(f"{type(request).__name__} is not supported")
+
+            counts["nMatched"] += result.matched_count
+            counts["nModified"] += result.modified_count
+            if result.upserted_id is not None:
+                counts["nUpserted"] += 1
+                upserted.append({"index": index, "_id": result.upserted_id})
+
+        return BulkWriteResult({**counts, "upserted": upserted}, True)
+
+    async def estimated_document_count(self) -> int:
+        """Return the number of documents."""
+        return len(self.documents)
+
+
+class InMemoryDatabase:
+    """A database creating its collections on first access."""
+
+    def __init__(self) -> None:
+        self.collections: dict[str, InMemoryCollection] = {}
+
+    def __getitem__(self, name: str) -> InMemoryCollection:
+        """Get a collection by name."""
+        return self.collections.setdefault(name, InMemoryCollection())
+
+    def __getattr__(self, name: str) -> InMemoryCollection:
+        """Get a collection by name."""
+        return self[name]
+
+
+class InMemoryClient:
+    """A client creating its databases on first access, whatever the URI."""
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:  # noqa: ANN401
+        self.databases: dict[str, InMemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> InMemoryDatabase:
+        """Get a database by name."""
+        return self.databases.setdefault(name, InMemoryDatabase())
+
+
+def install() -> None:
+    """Make pymongo create in-memory clients, before the backend is imported."""
+    pymongo.AsyncMongoClient = InMemoryClient
@@ -0,0 +1,82 @@
+"""
+Measure the memory taken by pages loaded from the DB, per page and per timer.
+
+Pages are built from documents like the page store loads them, and measured with tracemalloc.
+The per-timer cost is the difference between pages with and without timers.
+
+Run with `python -m benchmarks.page_memory` from the repository root.
+"""
+
+import datetime
+import gc
+import os
+import tracemalloc
+
+os.environ.setdefault("GIT_SHA", "development")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost")
+os.environ.setdefault("MONGO_DATABASE", "benchmark")
+
+from backend.deadlines import DeadlineScheduler  # noqa: E402
+from backend.timer import PageContext, TimerPage  # noqa: E402
+from backend.utils import random_string  # noqa: E402
+from backend.websocket_manager import WebsocketManager  # noqa: E402
+
+PAGE_COUNT = 100_000
+TIMER_COUNTS = (0, 1, 5)
+
+
+def make_document(timer_count: int) -> dict:
+    """Create the DB document of a page with some timers."""
+    return {
+        "public_link": random_string(8),
+        "edit_link": random_string(8),
+        "name": "Cloud-synchronized chronometers",
+        "color": "indigo",
+        "last_modified": datetime.datetime.now().isoformat(),
+        "origin": "https://chrono.example",
+        "version": 3,
+        "timers": [
+            {
+                "unpaused_time": None,
+                "remaining_duration": 300.0,
+                "is_paused": True,
+                "full_duration": 300.0,
+                "name": f"Round {i}",
+            }
+            for i in range(timer_count)
+        ],
+    }
+
+
+def measure(context: PageContext, timer_count: int) -> float:
+    """Return the memory in bytes taken by each loaded page with the given number of timers."""
+    documents = [make_document(timer_count) for _ in range(PAGE_COUNT)]
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    pages = [TimerPage.from_document(document, context) for document in documents]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # The strings of the documents are shared with the pages, as they are when loading from the DB
+    del pages
+    return (after - before) / PAGE_COUNT
+
+
+def main() -> None:
+    """Run the benchmark and print the results as a table."""
+    context = PageContext(WebsocketManager(), None, None, DeadlineScheduler())
+    empty = measure(context, 0)
+
+    print(f"{PAGE_COUNT} pages")
+    print(f"{'timers':>7} {'bytes/page':>11} {'bytes/timer':>12} {'total (MB)':>11}")
+    for timer_count in TIMER_COUNTS:
+        per_page = measure(context, timer_count) if timer_count else empty
+        per_timer = (per_page - empty) / timer_count if timer_count else 0
+        total = per_page * PAGE_COUNT / 1_000_000
+        print(f"{timer_count:>7} {per_page:>11.0f} {per_timer:>12.0f} {total:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Measure the encoding cost of a page broadcast against the number of subscribers.
+
+Compares building and encoding the page once per subscriber, like we used to do, with the
+cached per-version payload of `TimerPage.snapshot`.
+
+Run with `python -m benchmarks.payload_cache` from the repository root.
+"""
+
+import json
+import os
+import timeit
+from functools import partial
+
+os.environ.setdefault("GIT_SHA", "development")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost")
+os.environ.setdefault("MONGO_DATABASE", "benchmark")
+
+from backend.deadlines import DeadlineScheduler  # noqa: E402
+from backend.timer import PageContext, Timer, TimerPage  # noqa: E402
+from backend.websocket_manager import WebsocketManager  # noqa: E402
+
+SUBSCRIBER_COUNTS = (1, 10, 100, 1_000, 10_000)
+TIMERS_PER_PAGE = 10
+REPEAT = 5
+
+
+def make_page() -> TimerPage:
+    """Create a page with a few timers on it."""
+    manager = WebsocketManager()
+    page = TimerPage(PageContext(manager, None, None, DeadlineScheduler()))
+    page.timers = [Timer(300 + i, page, name=f"Round {i}") for i in range(TIMERS_PER_PAGE)]
+    return page
+
+
+def per_subscriber_encode(page: TimerPage, subscribers: int) -> None:
+    """Build and encode the payload once per subscriber."""
+    for _ in range(subscribers):
+        json.dumps(page.to_json())
+
+
+def cached_encode(page: TimerPage, subscribers: int) -> None:
+    """Encode the payload once per version and reuse it for every subscriber."""
+    page.version += 1
+    for _ in range(subscribers):
+        page.snapshot().json()
+
+
+def main() -> None:
+    """Run the benchmark and print the results as a table."""
+    page = make_page()
+
+    print(f"{'subscribers':>12} {'per-socket (ms)':>16} {'cached (ms)':>12} {'speedup':>8}")
+    for subscribers in SUBSCRIBER_COUNTS:
+        naive = min(
+            timeit.repeat(
+                partial(per_subscriber_encode, page, subscribers), number=1, repeat=REPEAT
+            )
+        )
+        cached = min(
+            timeit.repeat(partial(cached_encode, page, subscribers), number=1, repeat=REPEAT)
+        )
+
+        speedup = naive / cached
+        print(f"{subscribers:>12} {naive * 1000:>16.3f} {cached * 1000:>12.3f} {speedup:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
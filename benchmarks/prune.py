@@ -0,0 +1,97 @@
+"""
+Measure how long pruning blocks the event loop, depending on the number of entries.
+
+Compares the full copy-and-scan pass we used to run once an hour with the slices of
+`PrunableDict.prune` going through the expiration heap.
+
+Run with `python -m benchmarks.prune` from the repository root.
+"""
+
+import os
+import random
+import time
+
+os.environ.setdefault("GIT_SHA", "development")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost")
+os.environ.setdefault("MONGO_DATABASE", "benchmark")
+
+from backend.constants import PRUNE_SLICE_SIZE  # noqa: E402
+from backend.utils import PrunableDict  # noqa: E402
+
+ENTRY_COUNTS = (100_000, 250_000, 500_000, 1_000_000)
+EXPIRED_RATIO = 0.01
+
+
+class Entry:
+    """A minimal cache entry expiring at a fixed time."""
+
+    __slots__ = ("expires_at",)
+
+    def __init__(self, expires_at: float) -> None:
+        self.expires_at = expires_at
+
+    def is_expired(self) -> bool:
+        """Return True if the entry has expired."""
+        return time.time() > self.expires_at
+
+    def expiration_time(self) -> float:
+        """Return the timestamp at which the entry expires."""
+        return self.expires_at
+
+    def is_pinned(self) -> bool:
+        """Entries are never pinned."""
+        return False
+
+
+def make_dict(count: int) -> PrunableDict[int, Entry]:
+    """Fill a dict with entries, a small part of which is already expired."""
+    now = time.time()
+    data = PrunableDict()
+    for i in range(count):
+        if random.random() < EXPIRED_RATIO:
+            data[i] = Entry(now - random.uniform(0, 3600))
+        else:
+            data[i] = Entry(now + random.uniform(0, 7 * 24 * 3600))
+    return data
+
+
+def full_scan(data: PrunableDict) -> None:
+    """Prune like we used to, copying the dict and checking every entry."""
+    working_data = data._data.copy()
+    keys_to_remove = [key for key, value in working_data.items() if value.is_expired()]
+    for key in keys_to_remove:
+        del working_data[key]
+    data._data = working_data
+
+
+def sliced(data: PrunableDict) -> tuple[float, float]:
+    """Prune in slices, returning the total and the longest single pause."""
+    longest = total = 0.0
+    more = True
+    while more:
+        start = time.perf_counter()
+        more = data.prune(PRUNE_SLICE_SIZE)
+        pause = time.perf_counter() - start
+
+        total += pause
+        longest = max(longest, pause)
+    return total, longest
+
+
+def main() -> None:
+    """Run the benchmark and print the results as a table."""
+    print(
+        f"{'entries':>10} {'full scan (ms)':>15} {'sliced total (ms)':>18} {'max pause (ms)':>15}"
+    )
+    for count in ENTRY_COUNTS:
+        data = make_dict(count)
+        start = time.perf_counter()
+        full_scan(data)
+        scan = time.perf_counter() - start
+
+        total, longest = sliced(make_dict(count))
+        print(f"{count:>10} {scan * 1000:>15.2f} {total * 1000:>18.2f} {longest * 1000:>15.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Run the backend on the in-memory MongoDB stand-in, seeded with some pages.
+
+Used by the load test, which starts it in a separate process so its memory can be measured on
+its own. Run with `python -m benchmarks.server --pages 1000 --port 8123`.
+"""
+
+import argparse
+import datetime
+import os
+import resource
+import time
+
+os.environ.setdefault("GIT_SHA", "development")
+os.environ.setdefault("MONGO_URI", "memory://")
+os.environ.setdefault("MONGO_DATABASE", "benchmark")
+# The load test opens all its websockets at once, admission control would shed most of them
+os.environ.setdefault("SUBSCRIBE_ADMISSION_RATE", "0")
+os.environ.setdefault("TIME_ADMISSION_RATE", "0")
+
+from benchmarks.memory_collection import install  # noqa: E402
+
+install()
+
+import uvicorn  # noqa: E402
+
+import backend.main  # noqa: E402
+
+
+def seed(page_count: int) -> None:
+    """Fill the pages collection with some pages of a few timers."""
+    now = datetime.datetime.now().isoformat()
+    documents = backend.main.collection.documents
+
+    for i in range(page_count):
+        documents[f"p{i}"] = {
+            "_id": f"p{i}",
+            "public_link": f"p{i}",
+            "edit_link": f"e{i}",
+            "name": f"Page {i}",
+            "color": "indigo",
+            "last_modified": now,
+            "origin": "https://chrono.example",
+            "version": 1,
+            "timer_count": 3,
+            "timers": [
+                {
+                    "unpaused_time": None,
+                    "remaining_duration": 300.0,
+                    "is_paused": True,
+                    "full_duration": 300.0,
+                    "name": f"Round {j}",
+                }
+                for j in range(3)
+            ],
+        }
+
+
+def main() -> None:
+    """Seed the collection and serve the app until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pages", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8123)
+    args = parser.parse_args()
+
+    # Thousands of websockets need as many file descriptors
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard_limit, hard_limit))
+
+    start = time.perf_counter()
+    seed(args.pages)
+    print(f"seeded {args.pages} pages in {time.perf_counter() - start:.3f}s", flush=True)
+
+    uvicorn.run(backend.main.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
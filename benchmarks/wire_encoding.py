@@ -0,0 +1,93 @@
+"""
+Compare the encodings of websocket messages, in bytes on the wire and CPU time per broadcast.
+
+Each broadcast builds a fresh message and encodes it once, like `Message` does for every
+subscriber sharing a subprotocol. The stdlib JSON encoder we used to use is the baseline.
+
+Run with `python -m benchmarks.wire_encoding` from the repository root.
+"""
+
+import json
+import os
+import timeit
+from functools import partial
+
+os.environ.setdefault("GIT_SHA", "development")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost")
+os.environ.setdefault("MONGO_DATABASE", "benchmark")
+
+from backend.deadlines import DeadlineScheduler  # noqa: E402
+from backend.messages import Message  # noqa: E402
+from backend.timer import PageContext, Timer, TimerPage  # noqa: E402
+from backend.websocket_manager import WebsocketManager  # noqa: E402
+
+PAGE_SIZES = {"typical": 5, "large": 200}  # timers per page
+NUMBER = 1000
+REPEAT = 5
+
+
+def make_page(timer_count: int) -> TimerPage:
+    """Create a page with some running and paused timers on it."""
+    manager = WebsocketManager()
+    page = TimerPage(PageContext(manager, None, None, DeadlineScheduler()), revision="3f9c0a7e51d2")
+    page.timers = [Timer(300 + i, page, name=f"Round {i}") for i in range(timer_count)]
+    for timer in page.timers[::2]:
+        timer.unpaused_time = 1_760_000_000.123
+        timer.is_paused = False
+    return page
+
+
+def messages(page: TimerPage) -> dict[str, dict]:
+    """Return the kinds of messages broadcast for a page."""
+    return {
+        "snapshot": {
+            "type": "snapshot",
+            "version": page.version,
+            "revision": page.revision,
+            "page": page.to_json(),
+        },
+        "patch": {
+            "type": "patch",
+            "version": page.version,
+            "revision": page.revision,
+            "changes": [page.timers[0].changes("unpaused_time", "is_paused")],
+        },
+    }
+
+
+def stdlib_json(data: dict) -> str:
+    """Encode a message like we used to."""
+    return json.dumps(data, separators=(",", ":"))
+
+
+def orjson_json(data: dict) -> str:
+    """Encode a message as JSON, like JSON subscribers get it."""
+    return Message(data).json()
+
+
+def msgpack(data: dict) -> bytes:
+    """Encode a message with msgpack, like msgpack subscribers get it."""
+    return Message(data).msgpack()
+
+
+ENCODERS = {"json (stdlib)": stdlib_json, "json (orjson)": orjson_json, "msgpack": msgpack}
+
+
+def main() -> None:
+    """Run the benchmark and print the results as a table."""
+    print(f"{'page':>8} {'message':>9} {'encoding':>14} {'bytes':>8} {'encode (µs)':>12}")
+    for page_name, timer_count in PAGE_SIZES.items():
+        page = make_page(timer_count)
+
+        for message_name, data in messages(page).items():
+            for encoder_name, encoder in ENCODERS.items():
+                size = len(encoder(data))
+                seconds = min(timeit.repeat(partial(encoder, data), number=NUMBER, repeat=REPEAT))
+                print(
+                    f"{page_name:>8} {message_name:>9} {encoder_name:>14} "
+                    f"{size:>8} {seconds / NUMBER * 1_000_000:>12.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
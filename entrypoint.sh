@@ -3,6 +3,16 @@ set -e
 
 if [ -v USE_RELOADER ]; then
   extra_args=--reload
+elif [ "${WORKERS:-1}" -gt 1 ]; then
+  # Pages are sharded across worker processes, each owning the pages hashed to it
+  exec python -m backend.workers --host 0.0.0.0
 fi
 
-uvicorn backend.main:app --host 0.0.0.0 $extra_args
+# Frames are already compressed once for every subscriber unless WS_COMPRESSION_LEVEL is 0
+if [ "${WS_COMPRESSION_LEVEL:-6}" -gt 0 ]; then
+  default_deflate=false
+else
+  default_deflate=true
+fi
+
+uvicorn backend.main:app --host 0.0.0.0 --ws-per-message-deflate "${WS_PER_MESSAGE_DEFLATE:-$default_deflate}" $extra_args